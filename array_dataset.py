@@ -0,0 +1,173 @@
+"""Memory-mappable array output format.
+
+Instead of (or in addition to) one png per frame, the frames of a split are written into
+preallocated .npy files with one row per image:
+    {folder}/images_{split_name}.npy: (N, H, W, 4) uint8, RGBA color
+    {folder}/semantic_{split_name}.npy: (N, H, W) uint16, segment ids as in the panoptic pngs
+    {folder}/depth_{split_name}.npy: (N, H, W) uint16, depth in millimeters
+    {folder}/ids_{split_name}.npy: (N,) int64, sorted image ids of the rows
+    {folder}/complete_{split_name}.npy: (N,) bool, whether a row has been written
+
+The files can be opened with np.load(..., mmap_mode='r'), ArrayDataset provides access by image id.
+"""
+
+import os
+
+import numpy as np
+
+# depth is stored as uint16 in units of 1 / DEPTH_SCALE meters
+DEPTH_SCALE = 1000
+
+# depth format recorded in the json files if the depth is only written to the arrays, see writer.DEPTH_FORMATS
+DEPTH_FORMAT = 'uint16_mm'
+
+ARRAY_NAMES = ['images', 'semantic', 'depth', 'ids', 'complete']
+
+
+def array_path(folder, name, split_name):
+    return os.path.join(folder, f"{name}_{split_name}.npy")
+
+
+def metric_to_depth_array(depth_observation):
+    """Convert metric depth to the stored uint16 millimeters, depth beyond 65.535m is clipped.
+    """
+    return np.clip(np.round(depth_observation * DEPTH_SCALE), 0, np.iinfo(np.uint16).max).astype(np.uint16)
+
+
+class ArrayDatasetWriter:
+    """Writes frames into the preallocated arrays of one split.
+
+    The arrays have to be created with ArrayDatasetWriter.create first. Multiple writers, also
+    in different processes, can write different rows of the same split.
+    """
+    def __init__(self, folder, split_name):
+        self._arrays = {name: np.load(array_path(folder, name, split_name), mmap_mode='r+')
+                        for name in ARRAY_NAMES}
+
+    @staticmethod
+    def create(folder, split_name, image_ids, height, width, keep_existing=False):
+        """Preallocate the arrays of a split.
+
+        Args:
+            folder: The folder to write the arrays to.
+            split_name: Name of the split.
+            image_ids: Ids of all images of the split.
+            height: Height of the images.
+            width: Width of the images.
+            keep_existing:
+                Keep arrays written by a previous run if they match image_ids and resolution,
+                such that already written rows can be skipped.
+        """
+        image_ids = np.sort(np.asarray(image_ids, dtype=np.int64))
+        specs = {
+            'images': ((len(image_ids), height, width, 4), np.uint8),
+            'semantic': ((len(image_ids), height, width), np.uint16),
+            'depth': ((len(image_ids), height, width), np.uint16),
+            'ids': ((len(image_ids),), np.int64),
+            'complete': ((len(image_ids),), np.bool_),
+        }
+        if keep_existing and ArrayDatasetWriter._matches(folder, split_name, image_ids, specs):
+            return
+
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+        for name, (shape, dtype) in specs.items():
+            array = np.lib.format.open_memmap(array_path(folder, name, split_name), mode='w+', dtype=dtype, shape=shape)
+            if name == 'ids':
+                array[:] = image_ids
+            array.flush()
+            del array
+
+    @staticmethod
+    def _matches(folder, split_name, image_ids, specs):
+        try:
+            arrays = {name: np.load(array_path(folder, name, split_name), mmap_mode='r') for name in ARRAY_NAMES}
+        except (OSError, ValueError):
+            return False
+        return (all(arrays[name].shape == shape and arrays[name].dtype == dtype
+                    for name, (shape, dtype) in specs.items())
+                and np.array_equal(arrays['ids'], image_ids))
+
+    def _row(self, image_id):
+        row = np.searchsorted(self._arrays['ids'], image_id)
+        if row == len(self._arrays['ids']) or self._arrays['ids'][row] != image_id:
+            raise KeyError(f"Image id {image_id} is not part of the arrays")
+        return row
+
+    def write(self, image_id, color, semantic, depth_observation):
+        """Write the frames of one image.
+
+        Args:
+            image_id: Id of the image.
+            color: (H, W, 4) uint8 RGBA frame.
+            semantic: (H, W) segment ids, must fit into uint16.
+            depth_observation: (H, W) metric depth.
+        """
+        if semantic.max() > np.iinfo(np.uint16).max:
+            raise ValueError(f"Segment id {semantic.max()} of image {image_id} does not fit into uint16")
+        row = self._row(image_id)
+        self._arrays['images'][row] = color
+        self._arrays['semantic'][row] = semantic
+        self._arrays['depth'][row] = metric_to_depth_array(depth_observation)
+        # mark the row as written only after all of its data is
+        self._arrays['complete'][row] = True
+
+    def copy_rows(self, dataset, image_ids, chunk_size=64):
+        """Copy the stored frames of images from another ArrayDataset, e.g., of a shard, without converting them.
+        """
+        image_ids = np.sort(np.asarray(list(image_ids), dtype=np.int64))
+        for start in range(0, len(image_ids), chunk_size):
+            chunk = image_ids[start:start + chunk_size]
+            rows = [self._row(image_id) for image_id in chunk]
+            source_rows = [dataset.row(image_id) for image_id in chunk]
+            self._arrays['images'][rows] = dataset.images[source_rows]
+            self._arrays['semantic'][rows] = dataset.semantic[source_rows]
+            self._arrays['depth'][rows] = dataset.depth[source_rows]
+            self._arrays['complete'][rows] = True
+
+    def completed_ids(self):
+        return set(int(id) for id in self._arrays['ids'][self._arrays['complete']])
+
+    def close(self):
+        for array in self._arrays.values():
+            array.flush()
+        self._arrays = {}
+
+
+class ArrayDataset:
+    """Read-only, zero-copy access to the arrays of one split.
+
+    The returned frames are views into the memory-mapped files, no data is read or copied before
+    it is accessed.
+    """
+    def __init__(self, folder, split_name):
+        self.images = np.load(array_path(folder, 'images', split_name), mmap_mode='r')
+        self.semantic = np.load(array_path(folder, 'semantic', split_name), mmap_mode='r')
+        self.depth = np.load(array_path(folder, 'depth', split_name), mmap_mode='r')
+        self.ids = np.load(array_path(folder, 'ids', split_name))
+
+    def __len__(self):
+        return len(self.ids)
+
+    def row(self, image_id):
+        """Return the row of an image id in the arrays.
+        """
+        row = np.searchsorted(self.ids, image_id)
+        if row == len(self.ids) or self.ids[row] != image_id:
+            raise KeyError(f"Image id {image_id} is not part of the dataset")
+        return row
+
+    def color(self, image_id):
+        return self.images[self.row(image_id)]
+
+    def semantic_frame(self, image_id):
+        return self.semantic[self.row(image_id)]
+
+    def depth_frame(self, image_id):
+        """Return the depth of an image in millimeters, divide by DEPTH_SCALE for meters.
+        """
+        return self.depth[self.row(image_id)]
+
+    def __getitem__(self, image_id):
+        row = self.row(image_id)
+        return {'color': self.images[row], 'semantic': self.semantic[row], 'depth': self.depth[row]}
@@ -0,0 +1,390 @@
+"""Benchmarks for the CPU-side stages of the generator.
+
+The generator is run with a stand-in simulator returning synthetic color, depth and Replica-like
+instance frames, such that neither habitat-sim nor a GPU is required.
+
+Run the script using:
+    python3 benchmark.py
+"""
+
+import argparse
+import json
+import os
+import tempfile
+import time
+import timeit
+import types
+
+import numpy as np
+
+from generator import Generator, convert_categories, create_panoptic_dict, thing_labels
+from journal import AnnotationJournal, write_panoptic_json
+from poses import load_manifest
+from probe import ProbeCriteria
+from pyramid import PyramidLevel
+from segments import SceneLabels, compute_rle_counts, compute_segment_statistics
+from writer import (DEPTH_FORMATS, depth_extension, encode_depth, write_color_image, write_depth_array,
+                    write_depth_image, write_semantic_image)
+
+RESOLUTIONS = [(240, 320), (480, 640), (1080, 1920)]
+
+# number of instance ids per synthetic scene, similar to the larger Replica scenes
+NUM_IDS = 2000
+
+
+def synthetic_label_map(height, width, num_segments=60, seed=0, num_ids=NUM_IDS):
+    """Create a Replica-like instance frame.
+
+    The frame consists of large wall / floor / ceiling regions overlaid by randomly placed
+    object rectangles of different sizes.
+    """
+    rng = np.random.RandomState(seed)
+    ids = rng.choice(np.arange(1, num_ids), size=num_segments + 3, replace=False).astype(np.uint32)
+    label_map = np.empty((height, width), dtype=np.uint32)
+    label_map[:height // 4] = ids[0] # ceiling
+    label_map[height // 4:3 * height // 4] = ids[1] # wall
+    label_map[3 * height // 4:] = ids[2] # floor
+    for id in ids[3:]:
+        h = rng.randint(1, max(2, height // 3))
+        w = rng.randint(1, max(2, width // 3))
+        y = rng.randint(0, height - h + 1)
+        x = rng.randint(0, width - w + 1)
+        label_map[y:y + h, x:x + w] = id
+    return label_map
+
+
+def synthetic_observations(height, width, num_segments=60, seed=0):
+    """Create color, depth and semantic observations in the format returned by habitat-sim.
+    """
+    semantic = synthetic_label_map(height, width, num_segments, seed)
+    # flat colored segments with a shading gradient
+    color = np.empty((height, width, 4), dtype=np.uint8)
+    shading = np.linspace(0.6, 1.0, width)[None, :]
+    for channel, factor in enumerate([37, 91, 53]):
+        color[..., channel] = (((semantic * factor) % 256) * shading).astype(np.uint8)
+    color[..., 3] = 255
+    # piecewise smooth depth, constant per segment plus a gradient
+    depth = (semantic % 97).astype(np.float32) / 20 + np.linspace(0.5, 1.5, height, dtype=np.float32)[:, None]
+    return {'color_sensor': color, 'depth_sensor': depth, 'semantic_sensor': semantic}
+
+
+def synthetic_scene_dict(seed=0, num_ids=NUM_IDS):
+    """Create an info_semantic.json like dictionary, some ids have negative (undefined) labels.
+    """
+    rng = np.random.RandomState(seed)
+    names = ['wall', 'ceiling', 'floor', 'chair', 'table', 'lamp', 'sofa', 'bed', 'cushion', 'book']
+    labels = rng.randint(-1, len(names) + 1, size=num_ids)
+    labels[labels == 0] = 1
+    return {'classes': [{'id': i + 1, 'name': name} for i, name in enumerate(names)],
+            'id_to_label': labels.tolist()}
+
+
+class FakeAgent:
+    def __init__(self):
+        self._state = None
+
+    def get_state(self):
+        return self._state
+
+    def set_state(self, state):
+        self._state = state
+
+
+class FakeSimulator:
+    """Stand-in for habitat_sim.Simulator returning synthetic observations.
+
+    A small pool of observations is created up front and cycled through, such that the cost of
+    creating them does not distort the measured throughput. The probe agents, which follow the
+    num_agents full resolution agents, return depth and semantic frames at probe resolution. Every
+    fourth probe is too close to a wall, such that rejected poses are resampled.
+    """
+    def __init__(self, height, width, num_segments=60, pool_size=8, num_agents=1, num_probe_agents=0,
+                 probe_resolution=(30, 40)):
+        self._num_agents = num_agents
+        self._agents = [FakeAgent() for _ in range(num_agents + num_probe_agents)]
+        self._pool = [synthetic_observations(height, width, num_segments, seed) for seed in range(pool_size)]
+        self._next = 0
+        self._probe_pool = []
+        for seed in range(pool_size if num_probe_agents > 0 else 0):
+            probe = synthetic_observations(*probe_resolution, num_segments, seed)
+            depth = probe['depth_sensor'] * (0.1 if seed % 4 == 3 else 1)
+            self._probe_pool.append({'depth_sensor': depth, 'semantic_sensor': probe['semantic_sensor']})
+        self._next_probe = 0
+
+    def get_agent(self, agent_id):
+        return self._agents[agent_id]
+
+    def get_sensor_observations(self, agent_ids=0):
+        if not isinstance(agent_ids, int):
+            return {agent_id: self.get_sensor_observations(agent_id) for agent_id in agent_ids}
+        if agent_ids >= self._num_agents:
+            observations = self._probe_pool[self._next_probe % len(self._probe_pool)]
+            self._next_probe += 1
+            return observations
+        observations = self._pool[self._next % len(self._pool)]
+        self._next += 1
+        return observations
+
+    def close(self):
+        self._pool = []
+        self._probe_pool = []
+
+
+class BenchmarkGenerator(Generator):
+    """Generator rendering with FakeSimulator instead of habitat-sim.
+    """
+    def __init__(self, path, scenes=None, num_segments=60, **kwargs):
+        super().__init__(path, **kwargs)
+        if scenes is not None:
+            self._scenes = scenes
+        self._num_segments = num_segments
+
+    def _create_simulator(self, scene):
+        num_probe_agents = self._batch_size if self._probe_criteria is not None else 0
+        return FakeSimulator(self._height, self._width, self._num_segments, num_agents=self._batch_size,
+                             num_probe_agents=num_probe_agents, probe_resolution=self._probe_resolution)
+
+    def _create_agent_state(self, position, rotation):
+        return types.SimpleNamespace(position=position, rotation=types.SimpleNamespace(components=rotation))
+
+
+class Interrupted(Exception):
+    pass
+
+
+class InterruptedGenerator(BenchmarkGenerator):
+    """BenchmarkGenerator raising Interrupted after a number of rendered batches, as a run which is killed.
+    """
+    def __init__(self, path, num_batches, **kwargs):
+        super().__init__(path, **kwargs)
+        self._remaining_batches = num_batches
+
+    def render_batch(self, simulator, states):
+        if self._remaining_batches == 0:
+            raise Interrupted()
+        self._remaining_batches -= 1
+        return super().render_batch(simulator, states)
+
+
+def create_fake_dataset(folder, scenes):
+    """Write a synthetic info_semantic.json for each scene.
+    """
+    for i, scene in enumerate(scenes):
+        os.makedirs(os.path.join(folder, scene, 'habitat'))
+        with open(os.path.join(folder, scene, 'habitat', 'info_semantic.json'), 'w') as f:
+            json.dump(synthetic_scene_dict(seed=i), f)
+
+
+def legacy_segment_statistics(semantic_frame):
+    """Per segment mask based statistics, as originally done in Generator.update_dict.
+    """
+    ids, areas, bboxes = [], [], []
+    for id in np.unique(semantic_frame):
+        mask = semantic_frame == id
+        ys, xs = np.nonzero(mask)
+        ids.append(id)
+        areas.append(np.sum(mask))
+        bboxes.append([min(xs), min(ys), max(xs), max(ys)])
+    return np.array(ids), np.array(areas), np.array(bboxes)
+
+
+def _measure(function, repeats):
+    """Return the best time of a function in seconds.
+    """
+    return min(timeit.repeat(function, number=1, repeat=repeats))
+
+
+def benchmark_segment_statistics(resolutions=RESOLUTIONS, num_segments=60, repeats=5):
+    for height, width in resolutions:
+        label_map = synthetic_label_map(height, width, num_segments)
+
+        # both implementations have to agree exactly
+        for expected, actual in zip(legacy_segment_statistics(label_map),
+                                    compute_segment_statistics(label_map)):
+            assert np.array_equal(expected, actual)
+
+        legacy = _measure(lambda: legacy_segment_statistics(label_map), repeats)
+        vectorized = _measure(lambda: compute_segment_statistics(label_map), repeats)
+        print(f'segment statistics {width}x{height} ({len(np.unique(label_map))} segments): '
+              f'legacy {legacy * 1000:.2f} ms, vectorized {vectorized * 1000:.2f} ms, '
+              f'speedup {legacy / vectorized:.1f}x')
+
+
+def benchmark_stages(resolutions=RESOLUTIONS, num_segments=60, repeats=5, num_json_frames=200):
+    """Measure the per frame time of each CPU-side stage of the generator.
+    """
+    scene_dict = synthetic_scene_dict()
+    scene_labels = SceneLabels(scene_dict['id_to_label'], thing_labels(scene_dict))
+    for height, width in resolutions:
+        observations = synthetic_observations(height, width, num_segments)
+        generator = BenchmarkGenerator('', width=width, height=height)
+        with tempfile.TemporaryDirectory() as folder:
+            fixed = scene_labels.fix_semantic_observation(observations['semantic_sensor'])
+            depth_image = (observations['depth_sensor'] / 10 * 255).astype(np.uint8)
+            path = os.path.join(folder, 'frame.png')
+            ids = compute_segment_statistics(fixed)[0]
+            thing_ids = ids[(scene_labels.labels[ids] > 0) & scene_labels.is_thing[ids]]
+            level = PyramidLevel(height // 2, width // 2, depth_mode='min', semantic_mode='majority')
+            batch = (observations['color_sensor'][None], fixed[None], observations['depth_sensor'][None])
+            times = {
+                'semantic fixing': _measure(lambda: scene_labels.fix_semantic_observation(observations['semantic_sensor']),
+                                            repeats),
+                'segment statistics': _measure(lambda: compute_segment_statistics(fixed), repeats),
+                # only with --instances
+                'instance rle': _measure(lambda: compute_rle_counts(fixed, thing_ids), repeats),
+                # only with --pyramid, per level
+                'pyramid half': _measure(lambda: level.downsample(*batch), repeats),
+                'png color': _measure(lambda: write_color_image(observations['color_sensor'], path), repeats),
+                'png semantic': _measure(lambda: write_semantic_image(fixed, path), repeats),
+                'png depth': _measure(lambda: write_depth_image(depth_image, path), repeats),
+            }
+
+            # annotation entries are serialized into the journal, then assembled into the json
+            entries = []
+            generator._last_semantic_frame = fixed
+            generator.update_dict(types.SimpleNamespace(append=lambda *entry: entries.append(entry)),
+                                  scene_labels, 0, folder, 'bench', 'scene', [0, 0, 0, 1, 0, 0, 0])
+            with AnnotationJournal(folder, 'bench', 'scene') as journal:
+                start = time.perf_counter()
+                for _ in range(num_json_frames):
+                    journal.append(*entries[0])
+                times['json journal'] = (time.perf_counter() - start) / num_json_frames
+
+            panoptic_dict = create_panoptic_dict()
+            convert_categories(panoptic_dict, scene_dict)
+            start = time.perf_counter()
+            write_panoptic_json(panoptic_dict, folder, 'bench', ['scene'])
+            times['json assembly'] = (time.perf_counter() - start) / num_json_frames
+
+        total = sum(times.values())
+        print(f'stages {width}x{height} ({len(np.unique(fixed))} segments), '
+              f'{total * 1000:.2f} ms per frame, {1 / total:.1f} frames/s:')
+        for stage, stage_time in times.items():
+            print(f'    {stage:<20} {stage_time * 1000:8.3f} ms {100 * stage_time / total:5.1f}%')
+
+
+def benchmark_depth_formats(resolutions=RESOLUTIONS, num_segments=60, repeats=5, compress_levels=(1, 6)):
+    """Measure conversion plus encode time and file size of each depth format per frame.
+    """
+    for height, width in resolutions:
+        depth = synthetic_observations(height, width, num_segments)['depth_sensor'][None]
+        print(f'depth formats {width}x{height}:')
+        with tempfile.TemporaryDirectory() as folder:
+            for depth_format in DEPTH_FORMATS:
+                path = os.path.join(folder, 'depth' + depth_extension(depth_format))
+                if depth_extension(depth_format) == '.npy':
+                    options = [('', lambda: write_depth_array(encode_depth(depth, depth_format)[0], path))]
+                else:
+                    options = [(f' level {level}',
+                                lambda level=level: write_depth_image(encode_depth(depth, depth_format)[0], path, level))
+                               for level in compress_levels]
+                for name, function in options:
+                    encode_time = _measure(function, repeats)
+                    print(f'    {depth_format + name:<16} {encode_time * 1000:8.3f} ms '
+                          f'{os.path.getsize(path) / 1024:10.1f} KiB')
+
+
+def benchmark_generation(resolutions=RESOLUTIONS, num_segments=60, frames_per_room=2, num_scenes=3,
+                         writer_workers=0, batch_size=1, probe=False):
+    """Measure the throughput of the complete generator with the stand-in simulator.
+
+    With probe, the poses are probed and resampled before rendering, see probe.py.
+    """
+    generator = BenchmarkGenerator('')
+    scenes = generator._scenes[:num_scenes]
+    for height, width in resolutions:
+        with tempfile.TemporaryDirectory() as folder:
+            dataset_folder = os.path.join(folder, 'replica')
+            create_fake_dataset(dataset_folder, scenes)
+            generator = BenchmarkGenerator(dataset_folder, scenes=scenes, num_segments=num_segments,
+                                           width=width, height=height, writer_workers=writer_workers,
+                                           batch_size=batch_size,
+                                           probe_criteria=ProbeCriteria() if probe else None)
+            start = time.perf_counter()
+            generator.generate(os.path.join(folder, 'output'), 'bench', frames_per_room)
+            elapsed = time.perf_counter() - start
+            with open(os.path.join(folder, 'output', 'metrics.json'), 'r') as f:
+                metrics = json.load(f)
+            num_frames = sum(len(generator._scene_to_rooms[scene]) for scene in scenes) * frames_per_room
+        print(f'generation {width}x{height}: {num_frames} frames in {elapsed:.2f} s, '
+              f'{num_frames / elapsed:.1f} frames/s')
+        if probe:
+            statistics = metrics['probe']['total']
+            print(f'    probed {statistics["probed"]} poses, rejected {statistics["probed"] - statistics["accepted"]}, '
+                  f'{statistics["exhausted"]} frames without accepted pose')
+
+
+def benchmark_resume(resolution=RESOLUTIONS[0], num_segments=60, frames_per_room=2, num_scenes=3,
+                     interrupt_after=2):
+    """Interrupt a run with the stand-in simulator, resume it and check that the dataset is complete.
+
+    The run is interrupted in the first scene, before the journals of the other splits exist. It is then
+    resumed twice, the second time with an additional pyramid level. An AssertionError is raised if a
+    resumed dataset misses frames or has them in the wrong order.
+    """
+    height, width = resolution
+    generator = BenchmarkGenerator('')
+    scenes = generator._scenes[:num_scenes]
+    split_frames = {'val': frames_per_room, 'test': 1}
+    with tempfile.TemporaryDirectory() as folder:
+        dataset_folder = os.path.join(folder, 'replica')
+        create_fake_dataset(dataset_folder, scenes)
+        out_folder = os.path.join(folder, 'output')
+        options = dict(scenes=scenes, num_segments=num_segments, width=width, height=height,
+                       output_formats=['png', 'npy'], instances=True)
+        try:
+            InterruptedGenerator(dataset_folder, interrupt_after, **options).generate_splits(out_folder, split_frames)
+        except Interrupted:
+            pass
+        
+        for pyramid_levels in [[], [PyramidLevel(height // 2, width // 2)]]:
+            generator = BenchmarkGenerator(dataset_folder, pyramid_levels=pyramid_levels, **options)
+            start = time.perf_counter()
+            generator.generate_splits(out_folder, split_frames, resume=True)
+            elapsed = time.perf_counter() - start
+            for level_folder, _, _ in generator.output_folders(out_folder):
+                for split_name in split_frames:
+                    frame_numbers = load_manifest(os.path.join(level_folder, 'annotations'), split_name)['frame_numbers']
+                    with open(os.path.join(level_folder, 'annotations', f'panoptic_{split_name}.json'), 'r') as f:
+                        image_ids = [image['id'] for image in json.load(f)['images']]
+                    completed = set().union(*(generator.completed_frames(out_folder, split_name, scene)
+                                              for scene in scenes))
+                    assert image_ids == frame_numbers.tolist(), f'{level_folder} {split_name}: wrong images in json'
+                    assert completed == set(image_ids), f'{level_folder} {split_name}: incomplete frames'
+            print(f'resume {width}x{height} with {len(pyramid_levels)} pyramid levels: complete in {elapsed:.2f} s')
+
+
+def main():
+    """Main function of the program.
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument("benchmarks", nargs="*",
+                        help="Benchmarks to run: segments, stages, depth, generation and / or resume")
+    parser.add_argument("--resolutions", type=str, default=','.join(f'{h}x{w}' for h, w in RESOLUTIONS),
+                        help="Comma separated list of <height>x<width>")
+    parser.add_argument("--segments", type=int, help="Number of object segments per frame", default=60)
+    parser.add_argument("--repeats", type=int, help="Repetitions per measurement", default=5)
+    parser.add_argument("--frames-per-room", type=int, help="Frames per room of the generation benchmark", default=2)
+    parser.add_argument("--scenes", type=int, help="Number of scenes of the generation benchmark", default=3)
+    parser.add_argument("--writer-workers", type=int, help="Writer workers of the generation benchmark", default=0)
+    parser.add_argument("--batch-size", type=int, help="Poses per render call of the generation benchmark", default=1)
+    parser.add_argument("--probe", action="store_true", help="Probe and resample poses in the generation benchmark")
+    args = parser.parse_args()
+
+    benchmarks = args.benchmarks or ['segments', 'stages', 'depth', 'generation', 'resume']
+    resolutions = [tuple(int(v) for v in resolution.split('x')) for resolution in args.resolutions.split(',')]
+    if 'segments' in benchmarks:
+        benchmark_segment_statistics(resolutions, args.segments, args.repeats)
+    if 'stages' in benchmarks:
+        benchmark_stages(resolutions, args.segments, args.repeats)
+    if 'depth' in benchmarks:
+        benchmark_depth_formats(resolutions, args.segments, args.repeats)
+    if 'generation' in benchmarks:
+        benchmark_generation(resolutions, args.segments, args.frames_per_room, args.scenes, args.writer_workers,
+                             args.batch_size, args.probe)
+    if 'resume' in benchmarks:
+        benchmark_resume(resolutions[0], args.segments, args.frames_per_room, args.scenes)
+
+
+if __name__ == "__main__":
+    main()
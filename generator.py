@@ -3,22 +3,36 @@
 """
 
 import argparse
+import concurrent.futures
+import contextlib
 import datetime
+import itertools
 import json
+import multiprocessing
 import os
+import shutil
+import sys
 
 import numpy as np
-from PIL import Image
 
-import habitat_sim
-import habitat_sim.agent
-from habitat_sim.utils.common import d3_40_colors_rgb
-from habitat_sim.agent import AgentState
-from habitat_sim.utils.common import quat_from_angle_axis
-from habitat_sim.logging import logger
-import quaternion
+from array_dataset import DEPTH_FORMAT as ARRAY_DEPTH_FORMAT, ArrayDataset, ArrayDatasetWriter
+from journal import (INSTANCES_SECTION, JOURNAL_SECTIONS, AnnotationJournal, EntryBuffer, compact_journal,
+                     instances_path, journal_has_instances, merge_journals, read_journal, read_journal_ids, write_instances_json,
+                     write_panoptic_json)
+from metrics import Progress, RunMetrics, StageTimer
+from object_index import build_object_index, object_index_path, save_object_index
+from poses import (attempt_seeds, frame_seed, load_manifest, manifest_path, parse_shard, plan_differences,
+                   plan_poses, sample_room_poses, save_manifest, scene_frames, shard_manifests)
+from probe import REJECTION_REASONS, ProbeCriteria, add_probe_statistics, create_probe_statistics
+from pyramid import DEPTH_MODES, SEMANTIC_MODES, PyramidLevel, parse_level
+from segments import SceneLabels, compute_rle_counts, compute_segment_statistics
+from writer import (DEFAULT_PNG16_COMPRESSION, DEFAULT_PNG_COMPRESSION, DEPTH_FORMATS, ObservationWriter,
+                    depth_extension, depth_scale, detect_depth_format, encode_depth, read_semantic_image,
+                    write_color_image, write_depth_array, write_depth_image, write_semantic_image)
+
+# habitat-sim version from which get_sensor_observations renders multiple agents per call
+MIN_MULTI_AGENT_HABITAT_SIM = '0.2.0'
 
-from settings import make_cfg
 
 def create_panoptic_dict():
     panoptic_dict = {}
@@ -57,6 +71,13 @@ def convert_categories(panoptic_dict, scene_dict):
             'name': scene_category['name']
         })
     
+def thing_labels(scene_dict):
+    """Return the ids of the categories considered as things by convert_categories.
+    """
+    panoptic_dict = create_panoptic_dict()
+    convert_categories(panoptic_dict, scene_dict)
+    return [category['id'] for category in panoptic_dict['categories'] if category['isthing']]
+    
 
 def create_room(x_1, y_1, z_1, x_2, y_2, z_2):
     x_min = min(x_1, x_2)
@@ -75,8 +96,71 @@ def create_room(x_1, y_1, z_1, x_2, y_2, z_2):
 class Generator:
     """Generator for replica dataset, rgb, depth, and semantics.
     """
-    def __init__(self, path):
+    def __init__(self, path, seed=0, width=320, height=240, output_formats=('png',),
+                 writer_workers=0, writer_processes=False, writer_queue_size=None, progress_interval=10.0,
+                 batch_size=1, probe_criteria=None, probe_resolution=(30, 40), max_probe_attempts=20,
+                 instances=False, pyramid_levels=(), depth_format='png8', png_compression=DEFAULT_PNG_COMPRESSION,
+                 depth_compression=None):
+        """
+        Args:
+            path: The folder containing the Replica dataset.
+            seed: Base seed from which the seed of each frame is derived.
+            width: Width of the rendered images.
+            height: Height of the rendered images.
+            output_formats:
+                Formats the frames are written in, 'png' for one png per frame (COCO layout)
+                and / or 'npy' for memory-mappable arrays per split, see array_dataset.py.
+            writer_workers:
+                Number of workers encoding and writing images while the next frame is rendered.
+                0 writes synchronously.
+            writer_processes: Use processes instead of threads for the writer workers.
+            writer_queue_size: Maximum number of queued images before rendering blocks.
+            progress_interval: Minimum number of seconds between two progress lines.
+            batch_size: Number of poses rendered per simulator call, each by its own agent.
+            probe_criteria: ProbeCriteria to reject poses on a low resolution probe before rendering, None disables probing.
+            probe_resolution: Height and width of the probes.
+            max_probe_attempts: Maximum number of poses probed per frame before the last one is kept.
+            instances: Also write COCO instance annotations with RLE masks of all things to instances_{split}.json.
+            pyramid_levels:
+                PyramidLevels written in addition to the rendered resolution, reduced from the rendered frames
+                instead of rendering again, see pyramid.py.
+            depth_format: Format of the depth files, one of writer.DEPTH_FORMATS.
+            png_compression: zlib compression level (0-9) of the color and panoptic pngs.
+            depth_compression:
+                zlib compression level (0-9) of the depth pngs, by default 1 for png16 (faster than png8 at the
+                default level) and png_compression for png8.
+        """
         self._dataset_path = os.path.normpath(path)
+        self._seed = seed
+        
+        self._writer_workers = writer_workers
+        self._writer_processes = writer_processes
+        self._writer_queue_size = writer_queue_size
+        self._writer = ObservationWriter()
+        
+        self._output_formats = output_formats
+        self._array_writers = {}
+        
+        if depth_format not in DEPTH_FORMATS:
+            raise ValueError(f"Unknown depth format {depth_format}, expected one of {DEPTH_FORMATS}")
+        self._depth_format = depth_format
+        self._png_compression = png_compression
+        if depth_compression is None:
+            depth_compression = DEFAULT_PNG16_COMPRESSION if depth_format == 'png16' else png_compression
+        self._depth_compression = depth_compression
+        
+        self._instances = instances
+        self._journal_sections = JOURNAL_SECTIONS + [INSTANCES_SECTION] if instances else JOURNAL_SECTIONS
+        
+        self._batch_size = batch_size
+        
+        self._probe_criteria = probe_criteria
+        self._probe_resolution = probe_resolution
+        self._max_probe_attempts = max_probe_attempts
+        
+        # durations of the stages of the current scene
+        self._progress_interval = progress_interval
+        self._timer = StageTimer()
 
         self._scenes = ["apartment_0", "apartment_1", "apartment_2",
                         "frl_apartment_0", "frl_apartment_1", "frl_apartment_2",
@@ -84,13 +168,24 @@ class Generator:
                         "hotel_0", "office_0", "office_1", "office_2",
                         "office_3", "office_4", "room_0", "room_1", "room_2"]
         
-        self._height = 240
-        self._width = 320
+        self._height = height
+        self._width = width
+        
+        for level in pyramid_levels:
+            level.factors(height, width)
+        self._pyramid_levels = list(pyramid_levels)
         
         self._last_frame = None
         self._last_depth_frame = None
         self._last_semantic_frame = None
         
+        # parsed info_semantic.json and compiled lookup tables, cached for the whole run
+        self._scene_semantic_dicts = {}
+        self._scene_labels = {}
+        
+        # (split_name, frame_number) of the frames of the current scene with raw ids with the unexpected label 0
+        self._zero_label_frames = set()
+        
         self._scene_to_rooms = {
             "apartment_0": [
                 create_room(-0.3, 1.4, 2.8, 1.68, 0.28, 3.04), # bedroom
@@ -182,92 +277,223 @@ class Generator:
     def filename_from_frame_number(frame_number):
         return f"{frame_number:05d}.png"
     
+    def depth_filename_from_frame_number(self, frame_number, depth_format=None):
+        return f"{frame_number:05d}{depth_extension(depth_format or self._depth_format)}"
+    
     def load_scene_semantic_dict(self, scene):
-        with open(os.path.join(self._dataset_path, scene, 'habitat', 'info_semantic.json'), 'r') as f:
-            return json.load(f)
+        if scene not in self._scene_semantic_dicts:
+            with open(os.path.join(self._dataset_path, scene, 'habitat', 'info_semantic.json'), 'r') as f:
+                self._scene_semantic_dicts[scene] = json.load(f)
+        return self._scene_semantic_dicts[scene]
+    
+    def load_scene_labels(self, scene):
+        """Return the id lookup tables of a scene, compiled once per run.
+        """
+        if scene not in self._scene_labels:
+            scene_dict = self.load_scene_semantic_dict(scene)
+            self._scene_labels[scene] = SceneLabels(scene_dict['id_to_label'], thing_labels(scene_dict))
+        return self._scene_labels[scene]
         
-    def fix_semantic_observation(self, semantic_observation, scene_dict):
+    def fix_semantic_observation(self, semantic_observation, scene_labels):
         """Set id of negative categories to 0 to conform to COCO format.
         
         Replica *should* have no 0 id by default. If it does this code must probably be adjusted, except if 0 is undefined.
         """
-        for id in np.unique(semantic_observation):
-            if scene_dict['id_to_label'][id] < 0:
-                semantic_observation[semantic_observation==id] = 0
-            elif scene_dict['id_to_label'][id] == 0:
-                print('Warning: unexpected id 0 occured, considered as unlabeled...')
-                print(scene_dict)
-                
-        return semantic_observation
+        return scene_labels.fix_semantic_observation(semantic_observation)
 
-    def save_color_observation(self, observation, frame_number, out_folder):
-        if not os.path.exists(out_folder):
-            os.makedirs(out_folder)
-        color_observation = observation["color_sensor"]
-        color_img = Image.fromarray(color_observation, mode="RGBA")
-        color_img.save(os.path.join(out_folder, self.filename_from_frame_number(frame_number)))
-        self._last_frame = np.array(color_img)
+    def _save_file(self, write_function, image, filename, out_folder, stage, *args):
+        if 'png' not in self._output_formats:
+            return
+        # scenes rendered in parallel create the same folders
+        os.makedirs(out_folder, exist_ok=True)
+        self._writer.submit(write_function, image, os.path.join(out_folder, filename), *args, stage=stage)
 
-    def save_semantic_observation(self, observation, frame_number, out_folder, scene_dict):
-        if not os.path.exists(out_folder):
-            os.makedirs(out_folder)
-        semantic_observation = self.fix_semantic_observation(observation["semantic_sensor"], scene_dict)
-        semantic_img = Image.new("I", (semantic_observation.shape[1], semantic_observation.shape[0]))
-        semantic_img.putdata((semantic_observation.flatten()))
-        semantic_img.save(os.path.join(out_folder, self.filename_from_frame_number(frame_number)))
-        self._last_semantic_frame = np.array(semantic_img)
+    def output_folders(self, out_folder):
+        """Return the folder, height and width of each output, the rendered resolution first, then the pyramid levels.
+        """
+        return [(out_folder, self._height, self._width)] + [(level.folder(out_folder), level.height, level.width)
+                                                            for level in self._pyramid_levels]
 
-    def save_depth_observation(self, observation, frame_number, out_folder):
-        if not os.path.exists(out_folder):
-            os.makedirs(out_folder)
-        depth_observation = observation["depth_sensor"]
-        depth_img = Image.fromarray(
-            (depth_observation / 10 * 255).astype(np.uint8), mode="L"
-        )
-        depth_img.save(os.path.join(out_folder, self.filename_from_frame_number(frame_number)))
-        self._last_depth_frame = np.array(depth_img)
+    def _write_frames(self, color_frames, semantic_frames, depth_frames, frame_numbers, out_folder, split_name):
+        """Write the pngs and array rows of a batch of frames to one output folder.
+        
+        Returns:
+            The encoded depth images of the batch, None if only arrays are written.
+        """
+        # the arrays convert the metric depth themselves
+        depth_images = encode_depth(depth_frames, self._depth_format) if 'png' in self._output_formats else None
+        if depth_extension(self._depth_format) == '.npy':
+            depth_write_args = (write_depth_array,)
+        else:
+            depth_write_args = (write_depth_image, self._depth_compression)
+        for i, frame_number in enumerate(frame_numbers):
+            filename = self.filename_from_frame_number(frame_number)
+            self._save_file(write_color_image, color_frames[i], filename,
+                            os.path.join(out_folder, 'images', split_name), 'encode color', self._png_compression)
+            self._save_file(write_semantic_image, semantic_frames[i], filename,
+                            os.path.join(out_folder, 'annotations', f"panoptic_{split_name}"), 'encode semantic',
+                            self._png_compression)
+            if depth_images is not None:
+                self._save_file(depth_write_args[0], depth_images[i],
+                                self.depth_filename_from_frame_number(frame_number),
+                                os.path.join(out_folder, 'depth', split_name), 'encode depth', *depth_write_args[1:])
+            if (out_folder, split_name) in self._array_writers:
+                with self._timer.stage('array write'):
+                    self._array_writers[out_folder, split_name].write(frame_number, color_frames[i], semantic_frames[i],
+                                                                      depth_frames[i])
+        return depth_images
 
-    def save_observations(self, observation, frame_number, out_folder, split_name, scene_dict):
-        self.save_color_observation(observation, frame_number, os.path.join(out_folder, 'images', split_name))
-        self.save_semantic_observation(observation, frame_number, os.path.join(out_folder, 'annotations', f"panoptic_{split_name}"), scene_dict)
-        self.save_depth_observation(observation, frame_number, os.path.join(out_folder, 'depth', split_name))
+    def save_observation_batch(self, observations, frame_numbers, out_folder, split_name, scene_labels):
+        """Save the observations of multiple frames, stacked along the first axis.
         
-    def update_dict(self, panoptic_dict, scene_dict, frame_number, out_folder, split_name, scene, state):
-        panoptic_dict['images'].append({
+        Semantic fixing, depth conversion and the reduction to the pyramid levels are done for the whole batch at
+        once. The arrays must not be reused by the simulator while they are written, which holds for the stacked
+        arrays of render_batch.
+        
+        Args:
+            observations: Dictionary from sensor uuid to the observations of all frames of the batch.
+            frame_numbers: Frame number of each frame of the batch.
+            out_folder: The folder to write the dataset to.
+            split_name: Name of the split.
+            scene_labels: SceneLabels of the scene.
+        Returns:
+            The fixed semantic frames of the batch for each folder of output_folders, as needed by update_dict.
+        """
+        color_frames = observations["color_sensor"]
+        depth_frames = observations["depth_sensor"]
+        with self._timer.stage('semantic fixing'):
+            semantic_frames = self.fix_semantic_observation(observations["semantic_sensor"], scene_labels)
+            zero_label_frames = scene_labels.zero_label_frames(observations["semantic_sensor"])
+        self._zero_label_frames.update((split_name, frame_number)
+                                       for frame_number, zero_label in zip(frame_numbers, zero_label_frames)
+                                       if zero_label)
+        depth_images = self._write_frames(color_frames, semantic_frames, depth_frames, frame_numbers, out_folder,
+                                          split_name)
+        
+        self._last_frame = color_frames[-1]
+        self._last_semantic_frame = semantic_frames[-1]
+        self._last_depth_frame = depth_images[-1] if depth_images is not None else None
+        
+        output_semantic_frames = [semantic_frames]
+        for level in self._pyramid_levels:
+            with self._timer.stage('pyramid'):
+                level_frames = level.downsample(color_frames, semantic_frames, depth_frames)
+            self._write_frames(*level_frames, frame_numbers, level.folder(out_folder), split_name)
+            output_semantic_frames.append(level_frames[1])
+        return output_semantic_frames
+
+    def update_dict(self, journal, scene_labels, frame_number, out_folder, split_name, scene, pose,
+                    semantic_frame=None):
+        """Append the image and annotation entry of a frame to the journal.
+        
+        The segments are computed from semantic_frame, by default from the last saved frame.
+        
+        Args:
+            pose: Camera pose as x, y, z, quat_w, quat_x, quat_y, quat_z.
+        """
+        if semantic_frame is None:
+            semantic_frame = self._last_semantic_frame
+        
+        image = {
             'file_name': self.filename_from_frame_number(frame_number),
-            'height': self._height,
-            'width': self._width,
+            'height': int(semantic_frame.shape[0]),
+            'width': int(semantic_frame.shape[1]),
             'id': frame_number,
             'scene': scene,
-            'pose': list(state.position)+list(state.rotation.components)
-        })
+            'pose': list(pose)
+        }
         
-        panoptic_dict['annotations'].append({
+        annotation = {
             'segments_info': [],
             'file_name': self.filename_from_frame_number(frame_number),
             'image_id': frame_number
-        })
+        }
         
-        for id in np.unique(self._last_semantic_frame):
-            label = scene_dict['id_to_label'][id]
-            mask = self._last_semantic_frame == id
-            ys, xs = np.nonzero(mask)
-            minx, miny, maxx, maxy = min(xs), min(ys), max(xs), max(ys)
-            
+        # statistics of all segments are computed in one pass over the frame
+        ids, areas, bboxes = compute_segment_statistics(semantic_frame)
+        labels = scene_labels.labels[ids]
+        
+        for id, label, area, (minx, miny, maxx, maxy) in zip(ids, labels, areas, bboxes):
             if label > 0: # == 0 would be undefined -> no annotation
-                panoptic_dict['annotations'][-1]['segments_info'].append({
+                annotation['segments_info'].append({
                     'id': int(id), # the number in the semantic image
                     'category_id': int(label), # the matching category id 
                     'iscrowd': 0, 
                     'bbox': [int(minx),int(miny),int(maxx-minx),int(maxy-miny)], # x, y, (starting top left) width, height
-                    'area': int(np.sum(mask)) # area in pixels (exact, not bounding box)
+                    'area': int(area) # area in pixels (exact, not bounding box)
                 })
+        
+        if not self._instances:
+            journal.append(image, annotation)
+            return
+        
+        # instance masks of all things, encoded from one pass over the frame
+        things = (labels > 0) & scene_labels.is_thing[ids]
+        rle_counts = compute_rle_counts(semantic_frame, ids[things])
+        instances = {'image_id': frame_number, 'annotations': []}
+        for label, area, (minx, miny, maxx, maxy), counts in zip(labels[things], areas[things], bboxes[things],
+                                                                 rle_counts):
+            instances['annotations'].append({
+                'image_id': frame_number,
+                'category_id': int(label),
+                'segmentation': {'size': [int(semantic_frame.shape[0]), int(semantic_frame.shape[1])], 'counts': counts},
+                'area': int(area),
+                'bbox': [int(minx),int(miny),int(maxx-minx+1),int(maxy-miny+1)], # inclusive extent, as pycocotools.mask.toBbox
+                'iscrowd': 0
+            })
+        journal.append(image, annotation, instances)
     
-    def save_dict(self, panoptic_dict, out_folder, split_name):
-        with open(os.path.join(out_folder, 'annotations', f"panoptic_{split_name}.json"), 'w') as f:
-            json.dump(panoptic_dict, f)
+    def save_dict(self, out_folder, split_name, scenes, depth_format=None, instances=None):
+        """Assemble panoptic_{split_name}.json from the annotation journals of the given scenes.
+        
+        With instances enabled, instances_{split_name}.json is assembled as well, otherwise an existing one is removed
+        as it would not match the new annotations. The index of all objects of the split is written to
+        objects_{split_name}.npz, see object_index.py. The depth format recorded in the json
+        defaults to the one of the written depth files, or of the arrays if no depth files are written.
+        Whether instances are enabled defaults to the instances option of the generator.
+        """
+        if instances is None:
+            instances = self._instances
+        if depth_format is None:
+            depth_format = self._depth_format if 'png' in self._output_formats else ARRAY_DEPTH_FORMAT
+        panoptic_dict = create_panoptic_dict()
+        
+        # We only use one scene_semantic_dict to add categories to panoptic dict as all replica dicts
+        # contain all classes indepdentend of the scene.
+        convert_categories(panoptic_dict, self.load_scene_semantic_dict(self._scenes[-1]))
+        
+        # metric depth is the stored depth divided by depth_scale
+        panoptic_dict['info']['depth_format'] = depth_format
+        panoptic_dict['info']['depth_scale'] = depth_scale(depth_format)
+        
+        write_panoptic_json(panoptic_dict, out_folder, split_name, scenes)
+        
+        scene_annotations = ((scene, annotation) for scene in scenes
+                             for annotation in read_journal(out_folder, split_name, scene, 'annotations'))
+        save_object_index(build_object_index(scenes, scene_annotations), object_index_path(out_folder, split_name))
+        
+        if instances:
+            instances_dict = create_panoptic_dict()
+            instances_dict['categories'] = [{key: category[key] for key in ['supercategory', 'id', 'name']}
+                                            for category in panoptic_dict['categories'] if category['isthing']]
+            write_instances_json(instances_dict, out_folder, split_name, scenes)
+        elif os.path.exists(instances_path(out_folder, split_name)):
+            os.remove(instances_path(out_folder, split_name))
+            print(f'Removed {instances_path(out_folder, split_name)} of a previous run with instances, '
+                  'pass --instances to rebuild it')
+
+    def plan_splits(self, split_frames):
+        """Sample the camera poses of all frames of multiple splits.
+        
+        Args:
+            split_frames: Mapping from split name to the number of frames sampled in each room.
+        Returns:
+            Dictionary from split name to the pose manifest of the split, see poses.py.
+        """
+        return {split_name: plan_poses(self._scenes, self._scene_to_rooms, split_name, frames_per_room, self._seed)
+                for split_name, frames_per_room in split_frames.items()}
 
-    def generate(self, out_folder, split_name, frames_per_room=100):
+    def generate(self, out_folder, split_name, frames_per_room=100, workers=1, resume=False):
         """Generates dataset at specified path.
         
         Resulting folder structure (same as COCO)
@@ -281,9 +507,126 @@ class Generator:
         Args:
             out_folder: The folder to write the dataset to.
             split_name: Subfolder name, i.e., train, val, test
+            frames_per_room: Number of frames sampled in each room.
+            workers: Number of processes generating scenes in parallel, each with its own simulator.
+            resume: Only render frames which have not been completely written by a previous run.
         """
+        self.generate_splits(out_folder, {split_name: frames_per_room}, workers, resume)
+    
+    def generate_splits(self, out_folder, split_frames, workers=1, resume=False):
+        """Generates multiple splits of the dataset, loading each scene only once.
+        
+        The folder structure per split is the same as for generate.
+        
+        Args:
+            out_folder: The folder to write the dataset to.
+            split_frames: Mapping from split name to the number of frames sampled in each room.
+            workers: Number of processes generating scenes in parallel, each with its own simulator.
+            resume: Only render frames which have not been completely written by a previous run.
+        """
+        self.render_manifests(out_folder, self.plan_splits(split_frames), workers, resume)
+    
+    def render_manifests(self, out_folder, manifests, workers=1, resume=False, shard=None):
+        """Render the frames of pose manifests, loading each scene only once.
+        
+        The manifests are also written to {out_folder}/annotations/poses_{split_name}.npz, such that the same views
+        can be rendered again, e.g., with a different resolution. If poses are probed, the rejected poses are
+        replaced by the accepted ones once all scenes are done. A resumed run raises a ValueError before anything
+        is written if its manifests or resolution differ from the ones of the previous run. Timings of all stages and the probe statistics are
+        written to {out_folder}/metrics.json. Each pyramid level gets its own manifests, arrays and json files.
+        
+        Args:
+            out_folder: The folder to write the dataset to.
+            manifests: Dictionary from split name to the pose manifest of the split, see poses.py.
+            workers: Number of processes generating scenes in parallel, each with its own simulator.
+            resume: Only render frames which have not been completely written by a previous run.
+            shard:
+                Tuple (shard_index, num_shards) to only render the frames of one shard, see poses.shard_manifests.
+                The complete manifests are written nevertheless, the output folders of all shards are combined
+                with merge.
+        """
+        metrics = RunMetrics()
+        
+        rendered_manifests = manifests if shard is None else shard_manifests(manifests, *shard)
+        if resume:
+            # the existing frames are only kept if they show the same views, probed poses are not compared
+            for folder, height, width in self.output_folders(out_folder):
+                for split_name, manifest in manifests.items():
+                    annotations_folder = os.path.join(folder, 'annotations')
+                    if not os.path.exists(manifest_path(annotations_folder, split_name)):
+                        continue
+                    differences = plan_differences(load_manifest(annotations_folder, split_name),
+                                                   self._folder_manifest(manifest, height, width))
+                    if differences:
+                        raise ValueError(f"Cannot resume {folder}: the {split_name} manifest differs from the one of "
+                                         f"the previous run in {', '.join(differences)}, e.g., because of a different "
+                                         f"seed, resolution, number of frames or pose manifest")
+        for folder, height, width in self.output_folders(out_folder):
+            for split_name, manifest in manifests.items():
+                save_manifest(self._folder_manifest(manifest, height, width), os.path.join(folder, 'annotations'),
+                              split_name)
+                if 'npy' in self._output_formats:
+                    ArrayDatasetWriter.create(os.path.join(folder, 'arrays'), split_name,
+                                              rendered_manifests[split_name]['frame_numbers'], height, width,
+                                              keep_existing=resume)
+        total_frames = {split_name: len(manifest['frame_numbers']) for split_name, manifest in rendered_manifests.items()}
+        
+        scene_manifests = {scene: {split_name: scene_frames(manifest, scene)
+                                   for split_name, manifest in rendered_manifests.items()}
+                           for scene in self._scenes}
+        scene_sizes = {scene: sum(len(manifest['frame_numbers']) for manifest in scene_manifests[scene].values())
+                       for scene in self._scenes}
+        scenes = [scene for scene in self._scenes if scene_sizes[scene] > 0]
+        
+        progress = Progress(sum(total_frames.values()), interval=self._progress_interval)
+        
+        scene_args = {scene: (scene, scene_manifests[scene], out_folder, resume) for scene in scenes}
+        if workers > 1:
+            with concurrent.futures.ProcessPoolExecutor(
+                    workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+                # submit largest scenes first to balance the load, journals are assembled in scene order
+                submission_order = sorted(scenes, key=lambda scene: -scene_sizes[scene])
+                futures = {executor.submit(self._generate_scene, *scene_args[scene]): scene for scene in submission_order}
+                for future in concurrent.futures.as_completed(futures):
+                    scene = futures[future]
+                    durations, num_rendered, probe_statistics = future.result()
+                    metrics.add_scene(scene, durations, num_rendered, probe_statistics)
+                    progress.update(rendered=num_rendered, skipped=scene_sizes[scene] - num_rendered)
+        else:
+            for scene in scenes:
+                durations, num_rendered, probe_statistics = self._generate_scene(*scene_args[scene], progress=progress)
+                metrics.add_scene(scene, durations, num_rendered, probe_statistics)
+        
+        if self._probe_criteria is not None:
+            # replace the planned poses by the accepted ones, such that the manifests can be rendered again
+            manifests = self._merge_probed_poses(out_folder, manifests, scenes)
+            for folder, height, width in self.output_folders(out_folder):
+                for split_name, manifest in manifests.items():
+                    save_manifest(self._folder_manifest(manifest, height, width), os.path.join(folder, 'annotations'),
+                                  split_name)
+        
+        for folder, _, _ in self.output_folders(out_folder):
+            for split_name in manifests:
+                with metrics.stage('json assembly'):
+                    self.save_dict(folder, split_name, scenes)
+        
+        metrics.save(os.path.join(out_folder, 'metrics.json'))
+    
+    @staticmethod
+    def _folder_manifest(manifest, height, width):
+        """Return a manifest with the resolution of the output folder it is written to.
+        """
+        return dict(manifest, resolution=np.array([height, width], dtype=np.int64))
+    
+    def _create_simulator(self, scene):
+        """Create the simulator rendering a scene.
+        
+        habitat-sim is only imported here, such that the rest of the generator can be used without it.
+        """
+        import habitat_sim
+        from settings import make_cfg
+        
         settings = {}
-        print(out_folder)
         settings['width'] = self._width
         settings['height'] = self._height
         settings["sensor_height"] = 0
@@ -291,82 +634,655 @@ class Generator:
         settings["depth_sensor"] = True
         settings["semantic_sensor"] = True
         settings["silent"] = True
+        settings["num_agents"] = self._batch_size
+        if self._probe_criteria is not None:
+            settings["num_probe_agents"] = self._batch_size
+            settings["probe_height"], settings["probe_width"] = self._probe_resolution
+        settings["scene"] = os.path.join(self._dataset_path, scene, "habitat", "mesh_semantic.ply")
+        cfg = make_cfg(settings)
+        return habitat_sim.Simulator(cfg)
+    
+    def _create_agent_state(self, position, rotation):
+        """Create the agent state for a camera pose given as position and w, x, y, z quaternion.
+        """
+        from habitat_sim.agent import AgentState
+        import quaternion
+        
+        state = AgentState()
+        state.position = position
+        state.rotation = quaternion.quaternion(*rotation)
+        return state
+    
+    def render_batch(self, simulator, states):
+        """Render the observations of multiple agent states, one per agent of the simulator.
+        
+        Returns:
+            Dictionary from sensor uuid to the observations of all states, stacked along the first axis.
+        """
+        if self._batch_size == 1:
+            simulator.get_agent(0).set_state(states[0])
+            return {uuid: frame[None].copy() for uuid, frame in simulator.get_sensor_observations().items()}
+        return self._render_agents(simulator, range(len(states)), states)
+    
+    def _render_agents(self, simulator, agent_ids, states):
+        agent_ids = list(agent_ids)
+        for agent_id, state in zip(agent_ids, states):
+            simulator.get_agent(agent_id).set_state(state)
+        try:
+            observations = simulator.get_sensor_observations(agent_ids=agent_ids)
+        except TypeError as e:
+            raise RuntimeError(f"Rendering with multiple agents, i.e., with batch size > 1 or probing, requires "
+                               f"habitat-sim {MIN_MULTI_AGENT_HABITAT_SIM} or newer") from e
+        return {uuid: np.stack([observations[agent_id][uuid] for agent_id in agent_ids])
+                for uuid in observations[agent_ids[0]]}
+    
+    @staticmethod
+    def _probed_poses_folder(out_folder, scene):
+        return os.path.join(out_folder, 'annotations', 'probed_poses', scene)
+    
+    def probe_scene(self, simulator, scene, scene_manifests, out_folder, scene_labels, resume=False):
+        """Replace the rejected poses of all splits of a scene by accepted ones, see probe_poses.
         
-        current_frame = 0
-        total_frames = 0
-        for scene in self._scenes:
-            for room in self._scene_to_rooms[scene]:
-                total_frames += frames_per_room
+        The accepted poses are stored in {out_folder}/annotations/probed_poses/{scene}/poses_{split_name}.npz,
+        a resumed run reuses them instead of probing again.
         
-        panoptic_dict = create_panoptic_dict()        
+        Returns:
+            Tuple (scene_manifests, statistics) of the manifests with the accepted poses and the probe statistics.
+        """
+        folder = self._probed_poses_folder(out_folder, scene)
+        statistics = create_probe_statistics()
+        probed_manifests = {}
+        for split_name, manifest in scene_manifests.items():
+            if resume and os.path.exists(manifest_path(folder, split_name)):
+                probed_manifest = load_manifest(folder, split_name)
+                if np.array_equal(probed_manifest['frame_numbers'], manifest['frame_numbers']):
+                    probed_manifests[split_name] = probed_manifest
+                    continue
+            
+            with self._timer.stage('probe'):
+                probed_manifests[split_name], split_statistics = self.probe_poses(simulator, scene, split_name,
+                                                                                  manifest, scene_labels)
+            add_probe_statistics(statistics, split_statistics)
+            save_manifest(probed_manifests[split_name], folder, split_name)
+        return probed_manifests, statistics
+    
+    def probe_poses(self, simulator, scene, split_name, manifest, scene_labels):
+        """Probe the poses of a manifest and resample rejected poses in the same room until they are accepted.
+        
+        The i-th resampling of a frame is drawn from poses.attempt_seeds of its frame seed, such that the
+        accepted poses are reproducible and the number of frames per room is kept. Frames without an accepted
+        pose after max_probe_attempts keep their last pose.
         
-        for scene in self._scenes:
-            # setup the simulator
-            settings["scene"] = os.path.join(self._dataset_path, scene, "habitat", "mesh_semantic.ply")
-            cfg = make_cfg(settings)
-            simulator = habitat_sim.Simulator(cfg)
+        Returns:
+            Tuple (manifest, statistics) of the manifest with the accepted poses and the probe statistics.
+        """
+        rooms = self._scene_to_rooms[scene]
+        room_indices = manifest['room_indices']
+        seeds = frame_seed(self._seed, split_name, scene, room_indices, manifest['frame_indices'])
+        positions, rotations = manifest['positions'].copy(), manifest['rotations'].copy()
+        statistics = create_probe_statistics()
+        
+        # indices of the frames without an accepted pose
+        pending = np.arange(len(seeds))
+        for attempt in range(self._max_probe_attempts):
+            if len(pending) == 0:
+                break
+            if attempt > 0:
+                positions[pending], rotations[pending] = sample_room_poses(rooms, room_indices[pending],
+                                                                           attempt_seeds(seeds[pending], attempt))
             
-            # load semantic information for scene
-            scene_semantic_dict = self.load_scene_semantic_dict(scene)
+            reasons = np.concatenate([self._probe_batch(simulator, positions[batch], rotations[batch], scene_labels)
+                                      for batch in (pending[start:start + self._batch_size]
+                                                    for start in range(0, len(pending), self._batch_size))])
+            rejected = reasons >= 0
+            statistics['probed'] += len(pending)
+            statistics['accepted'] += int(np.count_nonzero(~rejected))
+            for reason, count in zip(REJECTION_REASONS, np.bincount(reasons[rejected], minlength=len(REJECTION_REASONS))):
+                statistics['rejected'][reason] += int(count)
+            pending = pending[rejected]
+        
+        statistics['exhausted'] = len(pending)
+        if len(pending) > 0:
+            print(f'Warning: no accepted pose for {len(pending)} {split_name} frames of {scene} after '
+                  f'{self._max_probe_attempts} attempts, keeping the last sampled poses...')
+        return dict(manifest, positions=positions, rotations=rotations), statistics
+    
+    def _probe_batch(self, simulator, positions, rotations, scene_labels):
+        states = [self._create_agent_state(position, rotation) for position, rotation in zip(positions, rotations)]
+        # the probe agents follow the agents rendering at full resolution
+        observations = self._render_agents(simulator, range(self._batch_size, self._batch_size + len(states)), states)
+        return self._probe_criteria.evaluate(observations['depth_sensor'], observations['semantic_sensor'],
+                                             scene_labels.labels)
+    
+    def _merge_probed_poses(self, out_folder, manifests, scenes):
+        """Return the manifests with the accepted poses of the given scenes, as stored by probe_scene.
+        """
+        merged = {}
+        for split_name, manifest in manifests.items():
+            positions, rotations = manifest['positions'].copy(), manifest['rotations'].copy()
+            rows = {int(frame_number): row for row, frame_number in enumerate(manifest['frame_numbers'])}
+            for scene in scenes:
+                folder = self._probed_poses_folder(out_folder, scene)
+                if not os.path.exists(manifest_path(folder, split_name)):
+                    continue
+                probed_manifest = load_manifest(folder, split_name)
+                scene_rows = [rows[int(frame_number)] for frame_number in probed_manifest['frame_numbers']]
+                positions[scene_rows] = probed_manifest['positions']
+                rotations[scene_rows] = probed_manifest['rotations']
+            merged[split_name] = dict(manifest, positions=positions, rotations=rotations)
+        return merged
+    
+    def completed_frames(self, out_folder, split_name, scene):
+        """Return the numbers of all frames of a scene which have been completely written by a previous run.
+        
+        A frame is complete if its color, depth and panoptic image (or array rows) have been written
+        and its entries are in the annotation journal, at the rendered resolution and all pyramid levels.
+        """
+        completed = None
+        for folder, _, _ in self.output_folders(out_folder):
+            folder_completed = self._completed_folder_frames(folder, split_name, scene, self._output_formats,
+                                                             self._depth_format, self._journal_sections)
+            completed = folder_completed if completed is None else completed & folder_completed
+        return completed
+    
+    def _completed_folder_frames(self, folder, split_name, scene, output_formats, depth_format, journal_sections):
+        """Return the numbers of the complete frames of a scene in a single output folder, see completed_frames.
+        """
+        completed = read_journal_ids(folder, split_name, scene, journal_sections)
+        if 'png' in output_formats:
+            for image_folder, filename_function in [
+                    (os.path.join(folder, 'images', split_name), self.filename_from_frame_number),
+                    (os.path.join(folder, 'annotations', f"panoptic_{split_name}"), self.filename_from_frame_number),
+                    (os.path.join(folder, 'depth', split_name),
+                     lambda frame_number: self.depth_filename_from_frame_number(frame_number, depth_format))]:
+                existing = set(os.listdir(image_folder)) if os.path.exists(image_folder) else set()
+                completed = {frame_number for frame_number in completed if filename_function(frame_number) in existing}
+        if 'npy' in output_formats:
+            array_writer = ArrayDatasetWriter(os.path.join(folder, 'arrays'), split_name)
+            completed &= array_writer.completed_ids()
+            array_writer.close()
+        return completed
+    
+    def _generate_scene(self, scene, scene_manifests, out_folder, resume=False, progress=None):
+        """Render and save all frames of one scene for all splits.
+        
+        The annotations are written to the scene's annotation journal of each split.
+        
+        Args:
+            scene: Name of the scene.
+            scene_manifests: Dictionary from split name to the pose manifest restricted to the scene's frames.
+            out_folder: The folder to write the dataset to.
+            resume: Skip frames which have been completely written by a previous run.
+            progress: Progress of the whole run, by default the progress of the scene is printed.
+        Returns:
+            Tuple (durations, num_rendered, probe_statistics) of the stage durations, the number of rendered
+            frames and the probe statistics (None if the scene has not been probed).
+        """
+        frame_numbers = {split_name: [int(frame_number) for frame_number in manifest['frame_numbers']]
+                         for split_name, manifest in scene_manifests.items()}
+        num_frames = sum(len(numbers) for numbers in frame_numbers.values())
+        if progress is None:
+            progress = Progress(num_frames, label=f'{scene}: ', interval=self._progress_interval)
+        self._timer = StageTimer()
+        self._zero_label_frames = set()
+        
+        completed = {split_name: set() for split_name in scene_manifests}
+        if resume:
+            for split_name in scene_manifests:
+                completed[split_name] = self.completed_frames(out_folder, split_name, scene)
+                # drop entries of incomplete frames, they are rendered again
+                for folder, _, _ in self.output_folders(out_folder):
+                    compact_journal(folder, split_name, scene, completed[split_name], self._journal_sections)
+            if all(set(frame_numbers[split_name]) <= completed[split_name] for split_name in scene_manifests):
+                print(f'Skipping {scene}, all frames are complete')
+                progress.update(rendered=0, skipped=num_frames)
+                return {}, 0, None
+        
+        with self._timer.stage('scene load'):
+            simulator = self._create_simulator(scene)
+        
+        # load semantic information for scene and compile the id lookup tables
+        scene_labels = self.load_scene_labels(scene)
+        
+        probe_statistics = None
+        self._writer = ObservationWriter(self._writer_workers, self._writer_queue_size, self._writer_processes)
+        if 'npy' in self._output_formats:
+            self._array_writers = {(folder, split_name): ArrayDatasetWriter(os.path.join(folder, 'arrays'), split_name)
+                                   for folder, _, _ in self.output_folders(out_folder) for split_name in scene_manifests}
+        num_rendered = 0
+        try:
+            if self._probe_criteria is not None:
+                scene_manifests, probe_statistics = self.probe_scene(simulator, scene, scene_manifests, out_folder,
+                                                                     scene_labels, resume)
             
-            # generate data for each room
-            for room in self._scene_to_rooms[scene]:
-                for _ in range(0,frames_per_room):
-                    agent = simulator.get_agent(0)
-                    agent_state = agent.get_state()
-                    random_state = AgentState()
-                    
-                    # this looks weird because coordinates have been collected in replica viewer,
-                    # which uses a different coordinate system than habitat-sim
-                    random_state.position[0] = np.random.uniform(room['x_min'], room['x_max'])
-                    random_state.position[1] = np.random.uniform(room['z_min'], room['z_max'])
-                    random_state.position[2] = - np.random.uniform(room['y_min'], room['y_max'])
-                    random_state.rotation = (quat_from_angle_axis(np.random.uniform(0,np.pi), np.array([0,1,0]))*
-                                             quat_from_angle_axis(np.random.uniform(-np.pi/3,np.pi/16), np.array([1,0,0]))*
-                                             quat_from_angle_axis(np.random.uniform(-np.pi/16,np.pi/16), np.array([0,0,1])))
-                    list(state.position)+list(state.rotation.components)
-                    agent_state.sensor_states = {}
-                    agent.set_state(random_state)
-                    
-                    # do the actual rendering
-                    observations = simulator.get_sensor_observations()
-                    
-                    self.save_observations(observations, current_frame, out_folder, split_name, scene_semantic_dict)
-                    
-                    self.update_dict(panoptic_dict, scene_semantic_dict, current_frame, out_folder, split_name, scene, random_state)
+            for split_name, manifest in scene_manifests.items():
+                with contextlib.ExitStack() as stack:
+                    # one journal per output folder, in the order of output_folders
+                    journals = [stack.enter_context(AnnotationJournal(folder, split_name, scene, resume,
+                                                                      self._journal_sections))
+                                for folder, _, _ in self.output_folders(out_folder)]
+                    pending = [i for i, frame_number in enumerate(frame_numbers[split_name])
+                               if frame_number not in completed[split_name]]
+                    progress.update(rendered=0, skipped=len(frame_numbers[split_name]) - len(pending))
                     
-                    print(f'Saved image {current_frame+1}/{total_frames}')
-                    current_frame += 1
-                    
-            simulator.close()
+                    for start in range(0, len(pending), self._batch_size):
+                        batch = pending[start:start + self._batch_size]
+                        batch_frame_numbers = [frame_numbers[split_name][i] for i in batch]
+                        
+                        # do the actual rendering
+                        with self._timer.stage('render'):
+                            states = [self._create_agent_state(manifest['positions'][i], manifest['rotations'][i])
+                                      for i in batch]
+                            observations = self.render_batch(simulator, states)
+                        
+                        output_semantic_frames = self.save_observation_batch(observations, batch_frame_numbers,
+                                                                             out_folder, split_name, scene_labels)
+                        
+                        with self._timer.stage('annotation'):
+                            for journal, semantic_frames in zip(journals, output_semantic_frames):
+                                for frame_number, state, semantic_frame in zip(batch_frame_numbers, states,
+                                                                               semantic_frames):
+                                    pose = list(state.position)+list(state.rotation.components)
+                                    self.update_dict(journal, scene_labels, frame_number, out_folder, split_name,
+                                                     scene, pose, semantic_frame)
+                        
+                        self._record_writer_durations()
+                        num_rendered += len(batch)
+                        progress.update(rendered=len(batch))
             
+            # all images have to be written before the annotations are
+            self._writer.flush()
+            self._record_writer_durations()
+        finally:
+            self._writer.close()
+            self._writer = ObservationWriter()
+            for array_writer in self._array_writers.values():
+                array_writer.close()
+            self._array_writers = {}
+            simulator.close()
             del simulator
         
-        # We only use last scene_semantic_dict to add categories to panoptic dict as all replica dicts
-        # contain all classes indepdentend of the scene.
-        convert_categories(panoptic_dict, scene_semantic_dict)
+        if resume:
+            # restore the frame order of the journals
+            for folder, _, _ in self.output_folders(out_folder):
+                for split_name in scene_manifests:
+                    compact_journal(folder, split_name, scene, frame_numbers[split_name], self._journal_sections)
+        
+        if self._zero_label_frames:
+            print(f'Warning: unexpected id 0 occured in {len(self._zero_label_frames)} frames of {scene}, '
+                  'considered as unlabeled...')
+        
+        return dict(self._timer.durations), num_rendered, probe_statistics
+    
+    def reannotate(self, out_folder, split_names=None, workers=1, chunk_size=64):
+        """Rebuild the annotations of an existing dataset from its panoptic pngs, without rendering.
+        
+        The frames of a split are taken from its pose manifest or, if there is none, from the images of its
+        existing panoptic json. Decoding the pngs and computing the segment statistics runs in parallel on
+        chunks of frames, the journals and json files are then written as by generate. The pyramid levels of the
+        dataset are annotated the same way from their own panoptic pngs.
+        
+        Args:
+            out_folder: The folder the dataset has been written to.
+            split_names: Names of the splits to annotate, by default all splits with panoptic pngs.
+            workers: Number of processes decoding and annotating frames.
+            chunk_size: Number of frames per job.
+        """
+        levels_folder = os.path.join(out_folder, 'pyramid')
+        levels = sorted(os.listdir(levels_folder)) if os.path.exists(levels_folder) else []
+        
+        executor = None
+        if workers > 1:
+            executor = concurrent.futures.ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('spawn'))
+        try:
+            self._reannotate_folder(out_folder, split_names, executor, chunk_size)
+            for level in levels:
+                self._reannotate_folder(os.path.join(levels_folder, level), split_names, executor, chunk_size,
+                                        label=f'{level} ')
+        finally:
+            if executor is not None:
+                executor.shutdown()
+    
+    def _reannotate_folder(self, out_folder, split_names, executor, chunk_size, label=''):
+        """Rebuild the annotations of a single output folder, see reannotate.
+        """
+        annotations_folder = os.path.join(out_folder, 'annotations')
+        if split_names is None:
+            split_names = sorted(folder[len('panoptic_'):] for folder in os.listdir(annotations_folder)
+                                 if folder.startswith('panoptic_') and not folder.endswith('_journal')
+                                 and os.path.isdir(os.path.join(annotations_folder, folder)))
+        
+        for split_name in split_names:
+            frames = self._annotation_frames(out_folder, split_name)
+            scenes = [scene for scene in self._scenes if frames.get(scene)]
+            jobs = [(scene, frames[scene][start:start + chunk_size])
+                    for scene in scenes for start in range(0, len(frames[scene]), chunk_size)]
+            
+            map_function = executor.map if executor is not None else map
+            results = map_function(self._annotate_frames, [out_folder] * len(jobs), [split_name] * len(jobs),
+                                   [scene for scene, _ in jobs], [job_frames for _, job_frames in jobs])
+            
+            progress = Progress(sum(len(frames[scene]) for scene in scenes), label=f'{label}{split_name}: ',
+                                interval=self._progress_interval)
+            for scene, scene_results in itertools.groupby(zip((scene for scene, _ in jobs), results),
+                                                          key=lambda result: result[0]):
+                with AnnotationJournal(out_folder, split_name, scene, sections=self._journal_sections) as journal:
+                    for _, entries in scene_results:
+                        for entry in entries:
+                            journal.append(*entry)
+                        progress.update(rendered=len(entries))
+            
+            # keep the depth metadata of the json matching the existing depth files or arrays
+            depth_format = detect_depth_format(os.path.join(out_folder, 'depth', split_name))
+            self.save_dict(out_folder, split_name, scenes, depth_format or ARRAY_DEPTH_FORMAT)
+    
+    def _annotation_frames(self, out_folder, split_name):
+        """Return a dictionary from scene to the list of (frame_number, pose) of all frames of a split.
+        """
+        annotations_folder = os.path.join(out_folder, 'annotations')
+        frames = {}
+        if os.path.exists(manifest_path(annotations_folder, split_name)):
+            manifest = load_manifest(annotations_folder, split_name)
+            for frame_number, scene_index, position, rotation in zip(manifest['frame_numbers'], manifest['scene_indices'],
+                                                                     manifest['positions'], manifest['rotations']):
+                frames.setdefault(str(manifest['scene_names'][scene_index]), []).append(
+                    (int(frame_number), list(position)+list(rotation)))
+        else:
+            with open(os.path.join(annotations_folder, f"panoptic_{split_name}.json"), 'r') as f:
+                for image in json.load(f)['images']:
+                    frames.setdefault(image['scene'], []).append((image['id'], image['pose']))
+        return frames
+    
+    def _annotate_frames(self, out_folder, split_name, scene, frames):
+        """Return the journal entries of frames, computed from their panoptic pngs.
+        """
+        scene_labels = self.load_scene_labels(scene)
+        folder = os.path.join(out_folder, 'annotations', f"panoptic_{split_name}")
+        buffer = EntryBuffer()
+        for frame_number, pose in frames:
+            semantic_frame = read_semantic_image(os.path.join(folder, self.filename_from_frame_number(frame_number)))
+            self.update_dict(buffer, scene_labels, frame_number, out_folder, split_name, scene, pose, semantic_frame)
+        return buffer.entries
+    
+    def merge(self, out_folder, shard_folders):
+        """Combine the output folders of shards rendered with render_manifests(..., shard=...) into one dataset.
+        
+        The complete manifests of all shards have to plan the same frames (see poses.plan_differences) and each of
+        their frames has to be complete in exactly one shard, otherwise a ValueError with the differences or the
+        missing and duplicate ids is raised before anything is written. The files of the frames are hard linked (copied if that is not possible) and the journals are
+        combined line by line, from which the json files are assembled as by generate. Hence, no image is decoded.
+        The pyramid levels of the shards are merged the same way. The instance annotations are merged if the
+        journals of the shards have them, independent of the instances option of the generator.
+        
+        Args:
+            out_folder: The folder to write the combined dataset to.
+            shard_folders: Output folders of the shards.
+        """
+        if os.path.normpath(out_folder) in [os.path.normpath(folder) for folder in shard_folders]:
+            raise ValueError(f"The merged dataset has to be written to a new folder, not to shard {out_folder}")
+        annotations_folder = os.path.join(shard_folders[0], 'annotations')
+        split_names = sorted(filename[len('poses_'):-len('.npz')] for filename in os.listdir(annotations_folder)
+                             if filename.startswith('poses_') and filename.endswith('.npz'))
         
-        self.save_dict(panoptic_dict, out_folder, split_name)    
+        # the frames are merged in the formats the shards have been written in
+        output_formats = [output_format for output_format, folder in [('png', 'images'), ('npy', 'arrays')]
+                          if os.path.exists(os.path.join(shard_folders[0], folder))]
+        
+        # the instance annotations are merged if the shards have been written with them
+        has_instances = {journal_has_instances(folder, split_name) for folder in shard_folders
+                         for split_name in split_names} - {None}
+        if len(has_instances) > 1:
+            raise ValueError("Cannot merge shards written with and without instances")
+        instances = has_instances == {True}
+        journal_sections = JOURNAL_SECTIONS + [INSTANCES_SECTION] if instances else JOURNAL_SECTIONS
+        
+        # check all splits before anything is written
+        splits = {}
+        for split_name in split_names:
+            manifests = [load_manifest(os.path.join(folder, 'annotations'), split_name) for folder in shard_folders]
+            for folder, manifest in zip(shard_folders, manifests):
+                differences = plan_differences(manifest, manifests[0])
+                if differences:
+                    raise ValueError(f"The {split_name} manifest of shard {folder} differs from the one of "
+                                     f"{shard_folders[0]} in {', '.join(differences)}")
+            # without depth files, the depth is only in the arrays
+            depth_formats = [detect_depth_format(os.path.join(folder, 'depth', split_name)) for folder in shard_folders]
+            depth_format = next((detected for detected in depth_formats if detected is not None),
+                                ARRAY_DEPTH_FORMAT)
             
+            # the pyramid levels are merged separately, hence only the given folders are checked
+            scenes = [scene for scene in self._scenes if len(scene_frames(manifests[0], scene)['frame_numbers']) > 0]
+            completed = [{scene: self._completed_folder_frames(folder, split_name, scene, output_formats, depth_format,
+                                                               journal_sections)
+                          for scene in scenes}
+                         for folder in shard_folders]
+            shard_ids = [np.array(sorted(set().union(*shard_completed.values())), dtype=np.int64)
+                         for shard_completed in completed]
+            ids, counts = np.unique(np.concatenate(shard_ids), return_counts=True)
+            missing = np.setdiff1d(manifests[0]['frame_numbers'], ids)
+            duplicates = ids[counts > 1]
+            unexpected = np.setdiff1d(ids, manifests[0]['frame_numbers'])
+            if len(missing) > 0 or len(duplicates) > 0 or len(unexpected) > 0:
+                raise ValueError(f"Cannot merge split {split_name}: {len(missing)} missing ids {missing[:10].tolist()}, "
+                                 f"{len(duplicates)} duplicate ids {duplicates[:10].tolist()}, "
+                                 f"{len(unexpected)} ids not in the manifest {unexpected[:10].tolist()}")
+            splits[split_name] = (manifests, scenes, completed, shard_ids, depth_format)
+        
+        for split_name, (manifests, scenes, completed, shard_ids, depth_format) in splits.items():
+            self._merge_split(out_folder, shard_folders, split_name, manifests, scenes, completed, shard_ids,
+                              output_formats, depth_format, journal_sections)
+            print(f'Merged {len(manifests[0]["frame_numbers"])} {split_name} frames of {len(shard_folders)} shards')
+        
+        levels_folder = os.path.join(shard_folders[0], 'pyramid')
+        for level in sorted(os.listdir(levels_folder)) if os.path.exists(levels_folder) else []:
+            self.merge(os.path.join(out_folder, 'pyramid', level),
+                       [os.path.join(folder, 'pyramid', level) for folder in shard_folders])
+    
+    def _merge_split(self, out_folder, shard_folders, split_name, manifests, scenes, completed, shard_ids,
+                     output_formats, depth_format, journal_sections):
+        """Write the frames, journals and json files of one split, see merge.
+        """
+        # the poses are taken from the shard which rendered the frame, they differ if poses were probed
+        manifest = dict(manifests[0], positions=manifests[0]['positions'].copy(),
+                        rotations=manifests[0]['rotations'].copy())
+        for shard_manifest, ids in zip(manifests, shard_ids):
+            rows = np.isin(manifest['frame_numbers'], ids)
+            manifest['positions'][rows] = shard_manifest['positions'][rows]
+            manifest['rotations'][rows] = shard_manifest['rotations'][rows]
+        save_manifest(manifest, os.path.join(out_folder, 'annotations'), split_name)
+        
+        if 'png' in output_formats:
+            for subfolder, filename_function in [
+                    (os.path.join('images', split_name), self.filename_from_frame_number),
+                    (os.path.join('annotations', f"panoptic_{split_name}"), self.filename_from_frame_number),
+                    (os.path.join('depth', split_name),
+                     lambda frame_number: self.depth_filename_from_frame_number(frame_number, depth_format))]:
+                os.makedirs(os.path.join(out_folder, subfolder), exist_ok=True)
+                for shard_folder, ids in zip(shard_folders, shard_ids):
+                    for frame_number in ids:
+                        self._link_file(os.path.join(shard_folder, subfolder, filename_function(frame_number)),
+                                        os.path.join(out_folder, subfolder, filename_function(frame_number)))
+        
+        if 'npy' in output_formats:
+            datasets = [ArrayDataset(os.path.join(folder, 'arrays'), split_name) for folder in shard_folders]
+            height, width = datasets[0].images.shape[1:3]
+            ArrayDatasetWriter.create(os.path.join(out_folder, 'arrays'), split_name, manifest['frame_numbers'],
+                                      height, width)
+            array_writer = ArrayDatasetWriter(os.path.join(out_folder, 'arrays'), split_name)
+            for dataset, ids in zip(datasets, shard_ids):
+                array_writer.copy_rows(dataset, ids)
+            array_writer.close()
+        
+        for scene in scenes:
+            merge_journals(shard_folders, out_folder, split_name, scene,
+                           [shard_completed[scene] for shard_completed in completed], journal_sections)
+        self.save_dict(out_folder, split_name, scenes, depth_format, INSTANCES_SECTION in journal_sections)
+    
+    @staticmethod
+    def _link_file(source, destination):
+        if os.path.exists(destination):
+            os.remove(destination)
+        try:
+            os.link(source, destination)
+        except OSError:
+            shutil.copyfile(source, destination)
+    
+    def _record_writer_durations(self):
+        for stage, seconds in self._writer.pop_durations():
+            self._timer.record(stage, seconds)
+            
+
+COMMANDS = ['generate', 'reannotate', 'merge']
 
-def main():
+
+def main(argv=None):
     """Main function of the program.
+    
+    Without a command, the arguments of the generate command are expected.
     """
-    parser = argparse.ArgumentParser()
-    parser.add_argument("dataset_folder", type=str, help="Folder containing Replica dataset")
-    parser.add_argument("--output", type=str, help="Output folder", default="")
-    args = parser.parse_args()
+    argv = sys.argv[1:] if argv is None else argv
+    if not argv or argv[0] not in COMMANDS + ['-h', '--help']:
+        argv = ['generate'] + argv
+    
+    common_parser = argparse.ArgumentParser(add_help=False)
+    common_parser.add_argument("dataset_folder", type=str, help="Folder containing Replica dataset")
+    common_parser.add_argument("--output", type=str, help="Output folder", default="")
+    common_parser.add_argument("--progress-interval", type=float, default=10.0,
+                               help="Minimum number of seconds between two progress lines")
+    
+    command_parser = argparse.ArgumentParser()
+    subparsers = command_parser.add_subparsers(dest="command", required=True)
+    parser = subparsers.add_parser("generate", parents=[common_parser], help="Render and annotate a new dataset")
+    parser.add_argument("--seed", type=int, default=0, help="Base seed of the camera pose sampling")
+    parser.add_argument("--instances", action="store_true",
+                        help="Also write COCO instance annotations with RLE masks to annotations/instances_{split}.json")
+    parser.add_argument("--width", type=int, default=320, help="Width of the rendered images")
+    parser.add_argument("--height", type=int, default=240, help="Height of the rendered images")
+    parser.add_argument("--plan-only", action="store_true",
+                        help="Only write the pose manifests of all splits to <output>/annotations without rendering")
+    parser.add_argument("--poses", type=str, default=None,
+                        help="Folder containing pose manifests poses_{split}.npz to render instead of sampling new poses")
+    parser.add_argument("--output-format", choices=['png', 'npy', 'both'], default='png',
+                        help="Write one png per frame, memory-mappable arrays per split, or both")
+    parser.add_argument("--resume", action="store_true",
+                        help="Only render frames which have not been completely written by a previous run")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Number of processes generating scenes in parallel")
+    parser.add_argument("--shard", type=str, default=None,
+                        help="Only render the frames of shard <index>/<num_shards> (index from 0), e.g., on one of "
+                             "several machines, the shard outputs are combined with the merge command")
+    parser.add_argument("--writer-workers", type=int, default=0,
+                        help="Number of workers writing images while rendering continues, 0 writes synchronously")
+    parser.add_argument("--writer-processes", action="store_true",
+                        help="Use processes instead of threads for the writer workers")
+    parser.add_argument("--writer-queue-size", type=int, default=None,
+                        help="Maximum number of queued images before rendering blocks")
+    parser.add_argument("--depth-format", choices=DEPTH_FORMATS, default='png8',
+                        help="Format of the depth files: 8 bit png of depth / 10 * 255, 16 bit png in millimeters or "
+                             "float16 / float32 .npy in meters")
+    parser.add_argument("--png-compression", type=int, choices=range(10), default=DEFAULT_PNG_COMPRESSION,
+                        help="zlib compression level of the color and panoptic pngs, lower levels encode faster "
+                             "into larger files")
+    parser.add_argument("--depth-compression", type=int, choices=range(10), default=None,
+                        help="zlib compression level of the depth pngs, by default 1 for png16 and --png-compression "
+                             "for png8")
+    parser.add_argument("--batch-size", type=int, default=1,
+                        help="Number of poses rendered per simulator call, each by its own agent, sizes > 1 "
+                             f"require habitat-sim {MIN_MULTI_AGENT_HABITAT_SIM} or newer")
+    parser.add_argument("--pyramid", type=str, nargs="+", default=[],
+                        help="Lower resolutions <height>x<width> reduced from the rendered frames and written to "
+                             "<output>/pyramid/<height>x<width>, each has to divide the rendered resolution")
+    parser.add_argument("--pyramid-depth", choices=DEPTH_MODES, default='nearest',
+                        help="Reduction of the depth of the pyramid levels")
+    parser.add_argument("--pyramid-semantic", choices=SEMANTIC_MODES, default='nearest',
+                        help="Reduction of the semantic frames of the pyramid levels")
+    parser.add_argument("--probe", action="store_true",
+                        help="Reject and resample degenerate poses based on a low resolution probe before rendering, "
+                             f"requires habitat-sim {MIN_MULTI_AGENT_HABITAT_SIM} or newer")
+    parser.add_argument("--probe-width", type=int, default=40, help="Width of the probes")
+    parser.add_argument("--probe-height", type=int, default=30, help="Height of the probes")
+    parser.add_argument("--probe-min-median-depth", type=float, default=0.5,
+                        help="Minimum median depth in meters of an accepted probe")
+    parser.add_argument("--probe-min-segments", type=int, default=3,
+                        help="Minimum number of distinct labeled segments of an accepted probe")
+    parser.add_argument("--probe-max-invalid-fraction", type=float, default=0.1,
+                        help="Maximum fraction of pixels without valid depth of an accepted probe")
+    parser.add_argument("--probe-max-attempts", type=int, default=20,
+                        help="Maximum number of poses probed per frame")
+    
+    reannotate_parser = subparsers.add_parser(
+        "reannotate", parents=[common_parser],
+        help="Rebuild the annotations of an existing dataset from its panoptic pngs, habitat-sim is not required")
+    reannotate_parser.add_argument("--instances", action="store_true",
+                                   help="Also write COCO instance annotations with RLE masks to "
+                                        "annotations/instances_{split}.json")
+    reannotate_parser.add_argument("--splits", type=str, nargs="+", default=None,
+                                   help="Splits to annotate, by default all splits with panoptic pngs")
+    reannotate_parser.add_argument("--workers", type=int, default=os.cpu_count(),
+                                   help="Number of processes decoding and annotating frames")
+    
+    merge_parser = subparsers.add_parser(
+        "merge", parents=[common_parser],
+        help="Combine the output folders of the shards of a run into one dataset, including their instance "
+             "annotations if they have been written with --instances, habitat-sim is not required")
+    merge_parser.add_argument("--shards", type=str, nargs="+", required=True,
+                              help="Output folders of all shards")
+    
+    args = command_parser.parse_args(argv)
+    
+    if args.command == 'reannotate':
+        generator = Generator(path=args.dataset_folder, progress_interval=args.progress_interval,
+                              instances=args.instances)
+        generator.reannotate(args.output, args.splits, args.workers)
+        return
+    
+    if args.command == 'merge':
+        generator = Generator(path=args.dataset_folder, progress_interval=args.progress_interval)
+        generator.merge(args.output, args.shards)
+        return
+    
+    probe_criteria = None
+    if args.probe:
+        probe_criteria = ProbeCriteria(min_median_depth=args.probe_min_median_depth,
+                                       min_segments=args.probe_min_segments,
+                                       max_invalid_fraction=args.probe_max_invalid_fraction)
 
-    generator = Generator(path=args.dataset_folder)
-    generator.generate(out_folder=args.output, 
-                       split_name='train',
-                       frames_per_room=200)
-    generator.generate(out_folder=args.output, 
-                       split_name='val',
-                       frames_per_room=20)
-    generator.generate(out_folder=args.output, 
-                       split_name='test',
-                       frames_per_room=20)
+    generator = Generator(path=args.dataset_folder,
+                          seed=args.seed,
+                          width=args.width,
+                          height=args.height,
+                          output_formats=['png', 'npy'] if args.output_format == 'both' else [args.output_format],
+                          writer_workers=args.writer_workers,
+                          writer_processes=args.writer_processes,
+                          writer_queue_size=args.writer_queue_size,
+                          progress_interval=args.progress_interval,
+                          batch_size=args.batch_size,
+                          instances=args.instances,
+                          probe_criteria=probe_criteria,
+                          probe_resolution=(args.probe_height, args.probe_width),
+                          max_probe_attempts=args.probe_max_attempts,
+                          depth_format=args.depth_format,
+                          png_compression=args.png_compression,
+                          depth_compression=args.depth_compression,
+                          pyramid_levels=[PyramidLevel(*parse_level(level), depth_mode=args.pyramid_depth,
+                                                       semantic_mode=args.pyramid_semantic)
+                                          for level in args.pyramid])
+    split_frames = {'train': 200, 'val': 20, 'test': 20}
+    if args.poses is not None:
+        manifests = {split_name: load_manifest(args.poses, split_name) for split_name in split_frames}
+    else:
+        manifests = generator.plan_splits(split_frames)
+    
+    if args.plan_only:
+        for split_name, manifest in manifests.items():
+            save_manifest(manifest, os.path.join(args.output, 'annotations'), split_name)
+        return
+    
+    generator.render_manifests(out_folder=args.output,
+                               manifests=manifests,
+                               workers=args.workers,
+                               resume=args.resume,
+                               shard=parse_shard(args.shard) if args.shard is not None else None)
     
 if __name__ == "__main__":
     main()
\ No newline at end of file
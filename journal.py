@@ -0,0 +1,238 @@
+"""Streaming storage of COCO panoptic annotations.
+
+Instead of keeping all entries in memory until the end of a run, the image and annotation entry
+of each finished frame are appended to a journal of JSON Lines files. The final COCO json is then
+assembled by streaming the journal lines into the output file.
+"""
+
+import json
+import os
+
+JOURNAL_SECTIONS = ['images', 'annotations']
+
+# optional section with the COCO instance annotations of each image
+INSTANCES_SECTION = 'instances'
+
+# key identifying the image of an entry in each section
+JOURNAL_ID_KEYS = {'images': 'id', 'annotations': 'image_id', INSTANCES_SECTION: 'image_id'}
+
+
+def journal_folder(out_folder, split_name):
+    return os.path.join(out_folder, 'annotations', f"panoptic_{split_name}_journal")
+
+
+def instances_path(out_folder, split_name):
+    return os.path.join(out_folder, 'annotations', f"instances_{split_name}.json")
+
+
+def journal_path(out_folder, split_name, scene, section):
+    return os.path.join(journal_folder(out_folder, split_name), f"{scene}_{section}.jsonl")
+
+
+class AnnotationJournal:
+    """Appends the entries of one scene and split to the journal files.
+
+    Each line of a journal file is the json of a single 'images' or 'annotations' entry, or of
+    the instance annotations of one image, i.e., {"image_id": ..., "annotations": [...]}.
+
+    Args:
+        out_folder: The folder the dataset is written to.
+        split_name: Name of the split.
+        scene: Name of the scene.
+        append: Keep the existing entries of the journal instead of starting a new one.
+        sections: Sections of the journal, JOURNAL_SECTIONS optionally followed by INSTANCES_SECTION.
+    """
+    def __init__(self, out_folder, split_name, scene, append=False, sections=JOURNAL_SECTIONS):
+        folder = journal_folder(out_folder, split_name)
+        os.makedirs(folder, exist_ok=True)
+        self._files = {section: open(journal_path(out_folder, split_name, scene, section), 'a' if append else 'w')
+                       for section in sections}
+
+    def append(self, *entries):
+        """Append the entries of one image, one per section.
+        """
+        for section, entry in zip(self._files, entries):
+            self._files[section].write(json.dumps(entry) + '\n')
+            self._files[section].flush()
+
+    def close(self):
+        for f in self._files.values():
+            f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class EntryBuffer:
+    """Collects the entries of AnnotationJournal.append in memory, e.g., to pass them between processes.
+    """
+    def __init__(self):
+        self.entries = []
+
+    def append(self, *entries):
+        self.entries.append(entries)
+
+
+def _read_journal_entries(out_folder, split_name, scene, section):
+    """Return a dictionary from image id to the (last) journal line of each image in a section.
+    """
+    path = journal_path(out_folder, split_name, scene, section)
+    entries = {}
+    if os.path.exists(path):
+        with open(path, 'r') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # last line of a journal which was interrupted while writing
+                    continue
+                entries[entry[JOURNAL_ID_KEYS[section]]] = line
+    return entries
+
+
+def read_journal(out_folder, split_name, scene, section):
+    """Yield the parsed entries of a section of a complete journal, in journal order.
+    """
+    with open(journal_path(out_folder, split_name, scene, section), 'r') as f:
+        for line in f:
+            yield json.loads(line)
+
+
+def read_journal_ids(out_folder, split_name, scene, sections=JOURNAL_SECTIONS):
+    """Return the ids of all images which have an entry in each section of the journal.
+    """
+    ids = [set(_read_journal_entries(out_folder, split_name, scene, section)) for section in sections]
+    return set.intersection(*ids)
+
+
+def journal_has_instances(out_folder, split_name):
+    """Return whether the journals of a split have the instances section, None if the split has no journals.
+    """
+    folder = journal_folder(out_folder, split_name)
+    filenames = [filename for filename in os.listdir(folder) if filename.endswith('.jsonl')] \
+        if os.path.exists(folder) else []
+    if not filenames:
+        return None
+    return any(filename.endswith(f"_{INSTANCES_SECTION}.jsonl") for filename in filenames)
+
+
+def compact_journal(out_folder, split_name, scene, keep_ids, sections=JOURNAL_SECTIONS):
+    """Rewrite the journal of a scene, keeping only the last entry of each of keep_ids, sorted by id.
+
+    This restores the order of a journal after frames have been appended out of order by a resumed run.
+    Sections without a journal file, e.g., of a split the previous run did not reach, are skipped.
+    """
+    for section in sections:
+        path = journal_path(out_folder, split_name, scene, section)
+        if not os.path.exists(path):
+            continue
+        entries = _read_journal_entries(out_folder, split_name, scene, section)
+        with open(path + '.tmp', 'w') as f:
+            for id in sorted(set(entries) & set(keep_ids)):
+                f.write(entries[id])
+        os.replace(path + '.tmp', path)
+
+
+def merge_journals(in_folders, out_folder, split_name, scene, keep_ids, sections=JOURNAL_SECTIONS):
+    """Write the journal of a scene combining the entries of keep_ids of the journals of multiple folders, sorted by id.
+
+    Args:
+        in_folders: Folders containing the journals to combine, e.g., the output folders of shards.
+        out_folder: Folder of the combined journal.
+        keep_ids: Ids of the images to keep from each of in_folders.
+    """
+    os.makedirs(journal_folder(out_folder, split_name), exist_ok=True)
+    for section in sections:
+        entries = {}
+        for in_folder, ids in zip(in_folders, keep_ids):
+            entries.update((id, line) for id, line in _read_journal_entries(in_folder, split_name, scene, section).items()
+                           if id in ids)
+        path = journal_path(out_folder, split_name, scene, section)
+        with open(path + '.tmp', 'w') as f:
+            for id in sorted(entries):
+                f.write(entries[id])
+        os.replace(path + '.tmp', path)
+
+
+def _write_journal_list(f, paths):
+    """Write the lines of multiple journal files as one json list, without parsing them.
+    """
+    f.write('[')
+    first = True
+    for path in paths:
+        with open(path, 'r') as journal_file:
+            for line in journal_file:
+                if not first:
+                    f.write(', ')
+                f.write(line.rstrip('\n'))
+                first = False
+    f.write(']')
+
+
+def write_panoptic_json(panoptic_dict, out_folder, split_name, scenes):
+    """Assemble panoptic_{split_name}.json from the journals of the given scenes.
+
+    The output is identical to json.dump of panoptic_dict with the journal entries inserted
+    into its 'images' and 'annotations' lists.
+
+    Args:
+        panoptic_dict: Dictionary with all non-journal entries, i.e., info, licenses and categories.
+        out_folder: The folder the dataset is written to.
+        split_name: Name of the split.
+        scenes: Scenes whose journals are concatenated, in this order.
+    """
+    with open(os.path.join(out_folder, 'annotations', f"panoptic_{split_name}.json"), 'w') as f:
+        f.write('{')
+        for i, (key, value) in enumerate(panoptic_dict.items()):
+            if i > 0:
+                f.write(', ')
+            f.write(json.dumps(key) + ': ')
+            if key in JOURNAL_SECTIONS:
+                _write_journal_list(f, [journal_path(out_folder, split_name, scene, key) for scene in scenes])
+            else:
+                f.write(json.dumps(value))
+        f.write('}')
+
+
+def _write_instance_annotations(f, paths):
+    """Write the instance annotations of multiple journal files as one json list, numbered from 1.
+    """
+    f.write('[')
+    next_id = 1
+    for path in paths:
+        with open(path, 'r') as journal_file:
+            for line in journal_file:
+                for annotation in json.loads(line)['annotations']:
+                    if next_id > 1:
+                        f.write(', ')
+                    f.write(json.dumps({'id': next_id, **annotation}))
+                    next_id += 1
+    f.write(']')
+
+
+def write_instances_json(instances_dict, out_folder, split_name, scenes):
+    """Assemble instances_{split_name}.json in COCO instance format from the journals of the given scenes.
+
+    Args:
+        instances_dict: Dictionary with all non-journal entries, i.e., info, licenses and categories.
+        out_folder: The folder the dataset is written to.
+        split_name: Name of the split.
+        scenes: Scenes whose journals are concatenated, in this order.
+    """
+    with open(instances_path(out_folder, split_name), 'w') as f:
+        f.write('{')
+        for i, (key, value) in enumerate(instances_dict.items()):
+            if i > 0:
+                f.write(', ')
+            f.write(json.dumps(key) + ': ')
+            if key == 'images':
+                _write_journal_list(f, [journal_path(out_folder, split_name, scene, 'images') for scene in scenes])
+            elif key == 'annotations':
+                _write_instance_annotations(f, [journal_path(out_folder, split_name, scene, INSTANCES_SECTION)
+                                                for scene in scenes])
+            else:
+                f.write(json.dumps(value))
+        f.write('}')
@@ -0,0 +1,133 @@
+"""Lightweight timing instrumentation and progress output.
+"""
+
+import collections
+import contextlib
+import datetime
+import json
+import time
+
+import numpy as np
+
+from probe import add_probe_statistics, create_probe_statistics
+
+
+class StageTimer:
+    """Collects the durations of named stages, e.g., of one scene.
+    """
+    def __init__(self):
+        self.durations = collections.defaultdict(list)
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.durations[name].append(time.perf_counter() - start)
+
+    def record(self, name, seconds):
+        self.durations[name].append(seconds)
+
+
+def summarize_durations(durations):
+    """Return total, count, mean, percentiles and maximum of a list of durations in seconds.
+    """
+    durations = np.asarray(durations, dtype=np.float64)
+    p50, p90, p99 = np.percentile(durations, [50, 90, 99])
+    return {'total': float(durations.sum()),
+            'count': len(durations),
+            'mean': float(durations.mean()),
+            'p50': float(p50),
+            'p90': float(p90),
+            'p99': float(p99),
+            'max': float(durations.max())}
+
+
+class RunMetrics:
+    """Stage durations of all scenes of a run.
+
+    Durations are collected per scene by a StageTimer (possibly in another process) and added
+    with add_scene once the scene is done. Stages not belonging to a scene are timed with stage.
+    """
+    def __init__(self):
+        self._start = time.perf_counter()
+        self._scenes = {}
+        self._scene_frames = {}
+        self._scene_probes = {}
+        self._run_timer = StageTimer()
+
+    def stage(self, name):
+        return self._run_timer.stage(name)
+
+    def add_scene(self, scene, durations, num_frames, probe_statistics=None):
+        self._scenes[scene] = {stage: list(values) for stage, values in durations.items()}
+        self._scene_frames[scene] = num_frames
+        if probe_statistics is not None:
+            self._scene_probes[scene] = probe_statistics
+
+    def summary(self):
+        elapsed = time.perf_counter() - self._start
+        num_frames = sum(self._scene_frames.values())
+        stages = collections.defaultdict(list)
+        for durations in [*self._scenes.values(), self._run_timer.durations]:
+            for stage, values in durations.items():
+                stages[stage].extend(values)
+        summary = {
+            'elapsed': elapsed,
+            'frames': num_frames,
+            'frames_per_second': num_frames / elapsed if elapsed > 0 else 0.0,
+            'stages': {stage: summarize_durations(values) for stage, values in stages.items()},
+            'scenes': {scene: {'frames': self._scene_frames[scene],
+                               'stages': {stage: summarize_durations(values) for stage, values in durations.items()}}
+                       for scene, durations in self._scenes.items()},
+        }
+        if self._scene_probes:
+            total = create_probe_statistics()
+            for statistics in self._scene_probes.values():
+                add_probe_statistics(total, statistics)
+            summary['probe'] = {'total': total, 'scenes': self._scene_probes}
+        return summary
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.summary(), f, indent=2)
+
+
+class Progress:
+    """Prints the progress of a run at most every interval seconds.
+
+    Args:
+        total: Total number of frames.
+        label: Prefix of the progress lines.
+        interval: Minimum number of seconds between two progress lines.
+    """
+    def __init__(self, total, label='', interval=10.0):
+        self._total = total
+        self._label = label
+        self._interval = interval
+        self._start = time.perf_counter()
+        self._last_print = self._start
+        self._done = 0
+        self._rendered = 0
+
+    def update(self, rendered=1, skipped=0):
+        """Count frames as done, frames which were not rendered (e.g. when resuming) are counted as skipped.
+        """
+        self._done += rendered + skipped
+        self._rendered += rendered
+        now = time.perf_counter()
+        if now - self._last_print >= self._interval or self._done == self._total:
+            self._last_print = now
+            self.print_progress(now)
+
+    def print_progress(self, now=None):
+        now = time.perf_counter() if now is None else now
+        frames_per_second = self._rendered / (now - self._start) if now > self._start else 0.0
+        remaining = self._total - self._done
+        if remaining == 0:
+            eta = datetime.timedelta(0)
+        else:
+            eta = datetime.timedelta(seconds=int(remaining / frames_per_second)) if frames_per_second > 0 else '?'
+        print(f'{self._label}{self._done}/{self._total} frames ({100 * self._done / max(self._total, 1):.1f}%), '
+              f'{frames_per_second:.1f} frames/s, ETA {eta}')
@@ -0,0 +1,187 @@
+"""Inverted index of the objects of a split.
+
+Objects are identified by (scene, segment_id), the segment ids of a scene are the same in all of
+its images. The index is stored as columnar arrays in {out_folder}/annotations/objects_{split_name}.npz:
+    scene_names: (S,) str, names of the scenes
+    object_keys: (O,) int64, sorted keys scene_index << 32 | segment_id of all objects
+    object_categories: (O,) int64, category id of each object
+    object_offsets: (O + 1,) int64, the views of object o are the rows object_offsets[o]:object_offsets[o + 1]
+    view_image_ids: (V,) int64, image id of each view, sorted by image id per object
+    view_areas: (V,) int64, area of each view in pixels
+    view_bboxes: (V, 4) int64, x, y, width, height of each view as in segments_info
+    category_ids: (C,) int64, sorted ids of all occurring categories
+    category_offsets: (C + 1,) int64, offsets into category_image_ids
+    category_image_ids: (Q,) int64, sorted ids of the images containing each category
+    image_ids: (I,) int64, sorted ids of all images with objects
+    image_offsets: (I + 1,) int64, offsets into image_objects
+    image_objects: (V,) int64, sorted indices of the objects visible in each image
+
+All lookups are binary searches into the sorted arrays followed by slicing.
+"""
+
+import os
+
+import numpy as np
+
+
+def object_index_path(out_folder, split_name):
+    return os.path.join(out_folder, 'annotations', f"objects_{split_name}.npz")
+
+
+def _offsets(counts):
+    return np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+
+
+def _object_key(scene_index, segment_id):
+    return (np.asarray(scene_index, dtype=np.int64) << 32) | np.asarray(segment_id, dtype=np.int64)
+
+
+def build_object_index(scene_names, scene_annotations):
+    """Build the index arrays from the panoptic annotation entries of a split.
+
+    Args:
+        scene_names: Names of the scenes of the split.
+        scene_annotations: Iterable of (scene, annotation) with the 'annotations' entries of all images.
+    Returns:
+        Dictionary of the index arrays, see the module documentation.
+    """
+    scene_indices = {scene: i for i, scene in enumerate(scene_names)}
+    image_ids, keys, categories, areas, bboxes = [], [], [], [], []
+    for scene, annotation in scene_annotations:
+        for segment in annotation['segments_info']:
+            image_ids.append(annotation['image_id'])
+            keys.append((scene_indices[scene] << 32) | segment['id'])
+            categories.append(segment['category_id'])
+            areas.append(segment['area'])
+            bboxes.append(segment['bbox'])
+    image_ids = np.array(image_ids, dtype=np.int64)
+    keys = np.array(keys, dtype=np.int64)
+    categories = np.array(categories, dtype=np.int64)
+    areas = np.array(areas, dtype=np.int64)
+    bboxes = np.array(bboxes, dtype=np.int64).reshape(-1, 4)
+
+    # views grouped by object, sorted by image id within each object
+    order = np.lexsort((image_ids, keys))
+    image_ids, keys, categories = image_ids[order], keys[order], categories[order]
+    areas, bboxes = areas[order], bboxes[order]
+    object_keys, first_views, views_per_object = np.unique(keys, return_index=True, return_counts=True)
+    view_objects = np.repeat(np.arange(len(object_keys)), views_per_object)
+
+    # images containing each category, without duplicates
+    category_images = np.unique(np.stack([categories, image_ids], axis=1), axis=0)
+    category_ids, images_per_category = np.unique(category_images[:, 0], return_counts=True)
+
+    # objects visible in each image
+    image_order = np.lexsort((view_objects, image_ids))
+    unique_image_ids, objects_per_image = np.unique(image_ids[image_order], return_counts=True)
+
+    return {
+        'scene_names': np.array(scene_names),
+        'object_keys': object_keys,
+        'object_categories': categories[first_views],
+        'object_offsets': _offsets(views_per_object),
+        'view_image_ids': image_ids,
+        'view_areas': areas,
+        'view_bboxes': bboxes,
+        'category_ids': category_ids,
+        'category_offsets': _offsets(images_per_category),
+        'category_image_ids': category_images[:, 1],
+        'image_ids': unique_image_ids,
+        'image_offsets': _offsets(objects_per_image),
+        'image_objects': view_objects[image_order],
+    }
+
+
+def save_object_index(index, path):
+    np.savez(path, **index)
+
+
+class ObjectIndex:
+    """Query interface of an object index written by save_object_index.
+
+    Args:
+        path: Path of the objects_{split_name}.npz file.
+    """
+    def __init__(self, path):
+        with np.load(path) as data:
+            for key in data.files:
+                setattr(self, key, data[key])
+        self._scene_indices = {str(scene): i for i, scene in enumerate(self.scene_names)}
+
+    def __len__(self):
+        return len(self.object_keys)
+
+    def _object(self, scene, segment_id):
+        if scene not in self._scene_indices:
+            raise KeyError(f"Scene {scene} is not part of the index")
+        key = _object_key(self._scene_indices[scene], segment_id)
+        i = np.searchsorted(self.object_keys, key)
+        if i == len(self.object_keys) or self.object_keys[i] != key:
+            raise KeyError(f"Segment {segment_id} of scene {scene} is not part of the index")
+        return i
+
+    def _objects(self, object_indices):
+        """Return the scenes and segment ids of objects given by their indices.
+        """
+        keys = self.object_keys[object_indices]
+        return self.scene_names[keys >> 32], keys & 0xFFFFFFFF
+
+    def category(self, scene, segment_id):
+        return int(self.object_categories[self._object(scene, segment_id)])
+
+    def views(self, scene, segment_id):
+        """Return all views of an object.
+
+        Returns:
+            Tuple (image_ids, areas, bboxes) of the images the object is visible in, sorted by image id.
+        """
+        i = self._object(scene, segment_id)
+        views = slice(self.object_offsets[i], self.object_offsets[i + 1])
+        return self.view_image_ids[views], self.view_areas[views], self.view_bboxes[views]
+
+    def images_with_category(self, category_id):
+        """Return the sorted ids of all images containing an object of a category.
+        """
+        i = np.searchsorted(self.category_ids, category_id)
+        if i == len(self.category_ids) or self.category_ids[i] != category_id:
+            return np.zeros(0, dtype=np.int64)
+        return self.category_image_ids[self.category_offsets[i]:self.category_offsets[i + 1]]
+
+    def objects_in_image(self, image_id):
+        """Return the objects visible in an image.
+
+        Returns:
+            Tuple (scenes, segment_ids) of the objects.
+        """
+        i = np.searchsorted(self.image_ids, image_id)
+        if i == len(self.image_ids) or self.image_ids[i] != image_id:
+            return np.zeros(0, dtype=self.scene_names.dtype), np.zeros(0, dtype=np.int64)
+        return self._objects(self.image_objects[self.image_offsets[i]:self.image_offsets[i + 1]])
+
+    def co_occurrences(self, scene, segment_id):
+        """Return the objects visible together with an object and the number of images they share.
+
+        Returns:
+            Tuple (scenes, segment_ids, counts), sorted by decreasing count.
+        """
+        image_rows = np.searchsorted(self.image_ids, self.views(scene, segment_id)[0])
+        objects = np.concatenate([self.image_objects[self.image_offsets[row]:self.image_offsets[row + 1]]
+                                  for row in image_rows])
+        objects, counts = np.unique(objects[objects != self._object(scene, segment_id)], return_counts=True)
+        order = np.argsort(-counts, kind='stable')
+        scenes, segment_ids = self._objects(objects[order])
+        return scenes, segment_ids, counts[order]
+
+    def category_frequency(self, scene=None):
+        """Return the number of distinct objects of each category, optionally of a single scene.
+
+        Returns:
+            Tuple (category_ids, counts).
+        """
+        categories = self.object_categories
+        if scene is not None:
+            # objects are sorted by scene, hence the objects of a scene are a contiguous range
+            scene_index = self._scene_indices[scene]
+            categories = categories[np.searchsorted(self.object_keys, _object_key(scene_index, 0)):
+                                    np.searchsorted(self.object_keys, _object_key(scene_index + 1, 0))]
+        return np.unique(categories, return_counts=True)
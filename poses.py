@@ -0,0 +1,256 @@
+"""Deterministic sampling of camera poses and pose manifests.
+
+Every pose is drawn from its own seed, derived from the base seed, split, scene, room index and
+frame index. Thus, a pose does not depend on which other frames have been generated before, which
+allows to resume and to partially re-render a run. All functions are vectorized, i.e., they
+accept arrays of room / frame indices.
+
+The poses of a split are planned up front and stored as a manifest, i.e., a dictionary of arrays
+with one row per frame:
+    frame_numbers: (N,) int64, number of the frame in the split
+    scene_indices: (N,) int16, index into scene_names
+    room_indices: (N,) int32, index of the room in the scene
+    frame_indices: (N,) int32, index of the frame in the room
+    positions: (N, 3) float64, camera positions in habitat-sim coordinates
+    rotations: (N, 4) float64, camera rotations as quaternion w, x, y, z
+    scene_names: (S,) str, names of the scenes
+    seed: () int64, base seed the poses have been sampled from
+    resolution: (2,) int64, height and width of the frames, only in the manifests of an output folder
+"""
+
+import hashlib
+import os
+
+import numpy as np
+
+_GOLDEN_GAMMA = np.uint64(0x9E3779B97F4A7C15)
+
+# entries of a manifest which are not per frame
+METADATA_KEYS = ['scene_names', 'seed', 'resolution']
+
+# entries which have to match to continue or combine the frames of a run, probing replaces positions and rotations
+PLAN_KEYS = ['frame_numbers', 'scene_names', 'scene_indices', 'room_indices', 'frame_indices', 'seed', 'resolution']
+
+
+def _splitmix64(x):
+    """Finalizer of the SplitMix64 generator, maps uint64 to well distributed uint64.
+    """
+    with np.errstate(over='ignore'):
+        z = np.asarray(x, dtype=np.uint64) + _GOLDEN_GAMMA
+        z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+        return z ^ (z >> np.uint64(31))
+
+
+def _string_hash(text):
+    return np.uint64(int.from_bytes(hashlib.blake2b(text.encode(), digest_size=8).digest(), 'little'))
+
+
+def frame_seed(base_seed, split_name, scene, room_index, frame_index):
+    """Derive the seed of a frame from its position in the run.
+
+    Args:
+        base_seed: Seed of the whole run.
+        split_name: Name of the split.
+        scene: Name of the scene.
+        room_index: Index of the room in the scene, int or array.
+        frame_index: Index of the frame in the room, int or array.
+    Returns:
+        uint64 seed(s) with the broadcast shape of room_index and frame_index.
+    """
+    return _frame_seed(_scene_seed(base_seed, split_name, scene), room_index, frame_index)
+
+
+def _scene_seed(base_seed, split_name, scene):
+    return _splitmix64(np.uint64(base_seed) ^ _string_hash(f"{split_name}/{scene}"))
+
+
+def _frame_seed(scene_seed, room_index, frame_index):
+    seed = _splitmix64(scene_seed ^ np.asarray(room_index, dtype=np.uint64))
+    return _splitmix64(seed ^ np.asarray(frame_index, dtype=np.uint64))
+
+
+def uniform(seed, stream, low, high):
+    """Draw a uniform number in [low, high) from the given stream of a seed.
+    """
+    with np.errstate(over='ignore'):
+        bits = _splitmix64(np.asarray(seed, dtype=np.uint64) + np.uint64(stream) * _GOLDEN_GAMMA)
+    return low + (high - low) * ((bits >> np.uint64(11)).astype(np.float64) * 2.0**-53)
+
+
+def quat_from_angle_axis(theta, axis):
+    """Vectorized version of habitat_sim.utils.common.quat_from_angle_axis.
+
+    Returns:
+        Array of shape (..., 4) containing w, x, y, z.
+    """
+    theta = np.asarray(theta, dtype=np.float64)[..., None]
+    return np.concatenate([np.cos(theta / 2), np.sin(theta / 2) * np.asarray(axis, dtype=np.float64)], axis=-1)
+
+
+def quat_multiply(p, q):
+    """Hamilton product of arrays of quaternions in w, x, y, z order.
+    """
+    pw, px, py, pz = np.moveaxis(p, -1, 0)
+    qw, qx, qy, qz = np.moveaxis(q, -1, 0)
+    return np.stack([pw * qw - px * qx - py * qy - pz * qz,
+                     pw * qx + px * qw + py * qz - pz * qy,
+                     pw * qy - px * qz + py * qw + pz * qx,
+                     pw * qz + px * qy - py * qx + pz * qw], axis=-1)
+
+
+def sample_poses(room, seeds):
+    """Sample camera poses inside a room.
+
+    Args:
+        room: Room dictionary as created by create_room, the bounds may also be arrays broadcastable to seeds.
+        seeds: uint64 seed or array of seeds, one per pose.
+    Returns:
+        Tuple (positions, rotations) of shape (..., 3) and (..., 4) (w, x, y, z) in habitat-sim coordinates.
+    """
+    # this looks weird because coordinates have been collected in replica viewer,
+    # which uses a different coordinate system than habitat-sim
+    positions = np.stack([uniform(seeds, 0, room['x_min'], room['x_max']),
+                          uniform(seeds, 1, room['z_min'], room['z_max']),
+                          - uniform(seeds, 2, room['y_min'], room['y_max'])], axis=-1)
+    rotations = quat_multiply(quat_multiply(quat_from_angle_axis(uniform(seeds, 3, 0, np.pi), [0, 1, 0]),
+                                            quat_from_angle_axis(uniform(seeds, 4, -np.pi/3, np.pi/16), [1, 0, 0])),
+                              quat_from_angle_axis(uniform(seeds, 5, -np.pi/16, np.pi/16), [0, 0, 1]))
+    return positions, rotations
+
+
+def sample_room_poses(rooms, room_indices, seeds):
+    """Sample one pose per seed inside the room of the scene given by room_indices.
+    """
+    bounds = {key: np.array([room[key] for room in rooms], dtype=np.float64)[room_indices]
+              for key in ['x_min', 'x_max', 'y_min', 'y_max', 'z_min', 'z_max']}
+    return sample_poses(bounds, seeds)
+
+
+def attempt_seeds(seeds, attempt):
+    """Derive the seeds of the attempt-th resampling of rejected poses, attempt 0 returns seeds unchanged.
+    """
+    seeds = np.asarray(seeds, dtype=np.uint64)
+    if attempt == 0:
+        return seeds
+    return _splitmix64(seeds ^ _splitmix64(np.uint64(attempt)))
+
+
+def plan_poses(scenes, scene_to_rooms, split_name, frames_per_room, base_seed):
+    """Sample the poses of all frames of a split in one vectorized batch.
+
+    Frames are numbered consecutively from 0, ordered by scene, room and frame index.
+
+    Args:
+        scenes: Names of the scenes, in generation order.
+        scene_to_rooms: Dictionary from scene name to the list of room dictionaries.
+        split_name: Name of the split.
+        frames_per_room: Number of frames sampled in each room.
+        base_seed: Seed of the whole run.
+    Returns:
+        The pose manifest of the split.
+    """
+    rooms = [(scene_index, room_index, room) for scene_index, scene in enumerate(scenes)
+             for room_index, room in enumerate(scene_to_rooms[scene])]
+    scene_indices = np.repeat(np.array([scene_index for scene_index, _, _ in rooms], dtype=np.int16), frames_per_room)
+    room_indices = np.repeat(np.array([room_index for _, room_index, _ in rooms], dtype=np.int32), frames_per_room)
+    frame_indices = np.tile(np.arange(frames_per_room, dtype=np.int32), len(rooms))
+
+    scene_seeds = np.array([_scene_seed(base_seed, split_name, scene) for scene in scenes], dtype=np.uint64)
+    seeds = _frame_seed(scene_seeds[scene_indices], room_indices, frame_indices)
+
+    # bounds of the room of each frame
+    bounds = {key: np.repeat(np.array([room[key] for _, _, room in rooms], dtype=np.float64), frames_per_room)
+              for key in ['x_min', 'x_max', 'y_min', 'y_max', 'z_min', 'z_max']}
+    positions, rotations = sample_poses(bounds, seeds)
+
+    return {
+        'frame_numbers': np.arange(len(seeds), dtype=np.int64),
+        'scene_indices': scene_indices,
+        'room_indices': room_indices,
+        'frame_indices': frame_indices,
+        'positions': positions,
+        'rotations': rotations,
+        'scene_names': np.array(scenes),
+        'seed': np.array(base_seed, dtype=np.int64),
+    }
+
+
+def select_frames(manifest, mask):
+    """Return the manifest restricted to the frames selected by a boolean mask or index array.
+    """
+    return {key: value if key in METADATA_KEYS else value[mask] for key, value in manifest.items()}
+
+
+def scene_frames(manifest, scene):
+    """Return the manifest restricted to the frames of one scene.
+    """
+    scene_names = list(manifest['scene_names'])
+    if scene not in scene_names:
+        return select_frames(manifest, np.zeros(len(manifest['frame_numbers']), dtype=bool))
+    return select_frames(manifest, manifest['scene_indices'] == scene_names.index(scene))
+
+
+def plan_differences(manifest, other):
+    """Return the PLAN_KEYS in which two manifests differ, a key missing in only one of them is a difference.
+    """
+    return [key for key in PLAN_KEYS if (key in manifest or key in other)
+            and (key not in manifest or key not in other or not np.array_equal(manifest[key], other[key]))]
+
+
+def parse_shard(shard):
+    """Return index and number of shards of a shard given as <index>/<num_shards>, the index starts from 0.
+    """
+    shard_index, num_shards = (int(value) for value in shard.split('/'))
+    if not 0 <= shard_index < num_shards:
+        raise ValueError(f"Invalid shard {shard}, the index has to be in [0, {num_shards})")
+    return shard_index, num_shards
+
+
+def shard_manifests(manifests, shard_index, num_shards):
+    """Restrict the manifests of all splits to the frames of one shard.
+
+    The frames of all splits are ordered by scene, split and frame number and cut into num_shards
+    contiguous ranges of (almost) the same size. Thus, the assignment only depends on the manifests
+    and each shard loads as few scenes as possible.
+
+    Args:
+        manifests: Dictionary from split name to the pose manifest of the split.
+        shard_index: Index of the shard, in [0, num_shards).
+        num_shards: Number of shards.
+    Returns:
+        Dictionary from split name to the manifest restricted to the frames of the shard.
+    """
+    split_names = list(manifests)
+    scene_names = list(dict.fromkeys(str(scene) for manifest in manifests.values() for scene in manifest['scene_names']))
+    scene_ranks = {scene: rank for rank, scene in enumerate(scene_names)}
+    scene_keys = np.concatenate([np.array([scene_ranks[str(scene)] for scene in manifest['scene_names']],
+                                          dtype=np.int64)[manifest['scene_indices']]
+                                 for manifest in manifests.values()])
+    split_sizes = [len(manifest['frame_numbers']) for manifest in manifests.values()]
+    split_keys = np.repeat(np.arange(len(split_names)), split_sizes)
+    frame_keys = np.concatenate([manifest['frame_numbers'] for manifest in manifests.values()])
+
+    # shard of each frame, in the order of the frames of the concatenated manifests
+    order = np.lexsort((frame_keys, split_keys, scene_keys))
+    shards = np.empty(len(order), dtype=np.int64)
+    shards[order] = np.arange(len(order)) * num_shards // max(len(order), 1)
+
+    offsets = np.cumsum([0] + split_sizes)
+    return {split_name: select_frames(manifests[split_name], shards[offsets[i]:offsets[i + 1]] == shard_index)
+            for i, split_name in enumerate(split_names)}
+
+
+def manifest_path(folder, split_name):
+    return os.path.join(folder, f"poses_{split_name}.npz")
+
+
+def save_manifest(manifest, folder, split_name):
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+    np.savez(manifest_path(folder, split_name), **manifest)
+
+
+def load_manifest(folder, split_name):
+    with np.load(manifest_path(folder, split_name)) as data:
+        return {key: data[key] for key in data.files}
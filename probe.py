@@ -0,0 +1,74 @@
+"""Cheap low-resolution probes to reject degenerate camera poses.
+
+Uniformly sampled poses may place the camera inside furniture, outside of the mesh or in front of
+a close wall. Before a frame is rendered at full resolution, a tiny depth / semantic probe is
+rendered from its pose and checked against ProbeCriteria. Rejected poses are resampled, such that
+the expensive rendering, encoding and annotation is only done for frames which are kept.
+"""
+
+import warnings
+
+import numpy as np
+
+# reasons a probe can be rejected for, in the order the criteria are checked
+REJECTION_REASONS = ['invalid pixels', 'close depth', 'few segments']
+
+
+class ProbeCriteria:
+    """Acceptance criteria of a pose, evaluated on its probe.
+
+    Args:
+        min_median_depth: Minimum median depth in meters of the valid pixels.
+        min_segments: Minimum number of distinct segments with a label > 0.
+        max_invalid_fraction: Maximum fraction of pixels without valid depth, e.g., holes in the mesh.
+    """
+    def __init__(self, min_median_depth=0.5, min_segments=3, max_invalid_fraction=0.1):
+        self.min_median_depth = min_median_depth
+        self.min_segments = min_segments
+        self.max_invalid_fraction = max_invalid_fraction
+
+    def evaluate(self, depth, semantic, labels):
+        """Evaluate a batch of probes.
+
+        Args:
+            depth: (B, H, W) metric depth of the probes.
+            semantic: (B, H, W) raw instance ids of the probes.
+            labels: Label of each raw instance id, i.e., SceneLabels.labels.
+        Returns:
+            (B,) int array, -1 for accepted probes, otherwise the index of the first violated
+            criterion in REJECTION_REASONS.
+        """
+        num_probes = len(depth)
+        depth = depth.reshape(num_probes, -1)
+        semantic = semantic.reshape(num_probes, -1)
+
+        invalid = ~np.isfinite(depth) | (depth <= 0)
+        invalid_fraction = invalid.mean(axis=1)
+        with warnings.catch_warnings():
+            # probes without any valid pixel have a nan median, they are rejected by their invalid fraction
+            warnings.simplefilter('ignore', RuntimeWarning)
+            median_depth = np.nanmedian(np.where(invalid, np.nan, depth), axis=1)
+
+        # number of distinct labeled ids per probe, from the steps of the sorted ids
+        labeled_ids = np.sort(np.where(labels[semantic] > 0, semantic, 0), axis=1)
+        num_segments = 1 + np.count_nonzero(np.diff(labeled_ids, axis=1), axis=1) - (labeled_ids[:, 0] == 0)
+
+        # first violated criterion of each probe, in the order of REJECTION_REASONS
+        violations = [invalid_fraction > self.max_invalid_fraction,
+                      ~(median_depth >= self.min_median_depth),
+                      num_segments < self.min_segments]
+        return np.select(violations, np.arange(len(violations)), default=-1)
+
+
+def create_probe_statistics():
+    return {'probed': 0, 'accepted': 0, 'exhausted': 0, 'rejected': {reason: 0 for reason in REJECTION_REASONS}}
+
+
+def add_probe_statistics(statistics, other):
+    """Add the counts of other to statistics in place.
+    """
+    for key in ['probed', 'accepted', 'exhausted']:
+        statistics[key] += other[key]
+    for reason in REJECTION_REASONS:
+        statistics['rejected'][reason] += other['rejected'][reason]
+    return statistics
@@ -0,0 +1,127 @@
+"""Lower resolution levels of a dataset, reduced from the frames rendered at full resolution.
+
+Instead of rendering the same poses once per resolution, the frames are rendered at the highest
+resolution and reduced to each level of the pyramid by integer factors:
+    color: area average of each block of pixels
+    depth: nearest (top left pixel of each block) or minimum of the valid depths of each block
+    semantic: nearest or the most frequent segment id of each block, ties go to the smaller id
+
+Each level is a complete dataset in {out_folder}/pyramid/{height}x{width}, with its own images,
+annotations and json files. All reductions work on a whole batch of frames at once.
+"""
+
+import os
+
+import numpy as np
+
+DEPTH_MODES = ['nearest', 'min']
+SEMANTIC_MODES = ['nearest', 'majority']
+
+
+def parse_level(level):
+    """Return height and width of a level given as <height>x<width>.
+    """
+    height, width = (int(value) for value in level.split('x'))
+    return height, width
+
+
+def _samples(frames, factors):
+    """Return the fy * fx sub-grids of (B, H, W, ...) frames, the i-th holds the i-th pixel of every block.
+    """
+    factor_y, factor_x = factors
+    return [frames[:, y::factor_y, x::factor_x] for y in range(factor_y) for x in range(factor_x)]
+
+
+def area_downsample(frames, factors):
+    """Average each block of pixels of uint8 frames, rounded to the nearest integer.
+    """
+    samples = _samples(frames, factors)
+    sums = samples[0].astype(np.uint32)
+    for sample in samples[1:]:
+        sums += sample
+    return ((sums + len(samples) // 2) // len(samples)).astype(frames.dtype)
+
+
+def nearest_downsample(frames, factors):
+    return np.ascontiguousarray(_samples(frames, factors)[0])
+
+
+def min_downsample(depth, factors):
+    """Minimum of the valid (> 0) depths of each block, 0 for blocks without valid depth.
+    """
+    minimum = np.full(_samples(depth, factors)[0].shape, np.inf, dtype=depth.dtype)
+    for sample in _samples(depth, factors):
+        np.minimum(minimum, np.where(sample > 0, sample, np.inf), out=minimum)
+    minimum[np.isinf(minimum)] = 0
+    return minimum
+
+
+def majority_downsample(semantic, factors):
+    """Most frequent segment id of each block, ties go to the smaller id.
+
+    The votes of each pixel of a block are counted by comparing it with all other pixels of the block,
+    which is faster than sorting the blocks for the small factors of a pyramid.
+    """
+    samples = _samples(semantic, factors)
+    majority = samples[0]
+    majority_votes = np.zeros(majority.shape, dtype=np.int32)
+    for candidate in samples:
+        votes = np.zeros(majority.shape, dtype=np.int32)
+        for sample in samples:
+            votes += candidate == sample
+        better = (votes > majority_votes) | ((votes == majority_votes) & (candidate < majority))
+        majority = np.where(better, candidate, majority)
+        majority_votes = np.where(better, votes, majority_votes)
+    return majority
+
+
+class PyramidLevel:
+    """A lower resolution level of the rendered frames.
+
+    Args:
+        height: Height of the level, has to divide the rendered height.
+        width: Width of the level, has to divide the rendered width.
+        depth_mode: Reduction of the depth, one of DEPTH_MODES.
+        semantic_mode: Reduction of the semantic frames, one of SEMANTIC_MODES.
+    """
+    def __init__(self, height, width, depth_mode='nearest', semantic_mode='nearest'):
+        if depth_mode not in DEPTH_MODES:
+            raise ValueError(f"Unknown depth mode {depth_mode}, expected one of {DEPTH_MODES}")
+        if semantic_mode not in SEMANTIC_MODES:
+            raise ValueError(f"Unknown semantic mode {semantic_mode}, expected one of {SEMANTIC_MODES}")
+        self.height = height
+        self.width = width
+        self.depth_mode = depth_mode
+        self.semantic_mode = semantic_mode
+
+    def folder(self, out_folder):
+        return os.path.join(out_folder, 'pyramid', f"{self.height}x{self.width}")
+
+    def factors(self, height, width):
+        """Return the integer reduction factors from the rendered height and width to the level.
+        """
+        if height % self.height != 0 or width % self.width != 0:
+            raise ValueError(f"Level {self.height}x{self.width} does not divide the resolution {height}x{width}")
+        return height // self.height, width // self.width
+
+    def downsample(self, color_frames, semantic_frames, depth_frames):
+        """Reduce a batch of frames to the level.
+
+        Args:
+            color_frames: (B, H, W, 4) uint8 RGBA frames.
+            semantic_frames: (B, H, W) fixed segment ids.
+            depth_frames: (B, H, W) metric depth.
+        Returns:
+            Tuple (color_frames, semantic_frames, depth_frames) at the resolution of the level.
+        """
+        factors = self.factors(*semantic_frames.shape[1:3])
+        color_frames = area_downsample(color_frames, factors)
+        if self.semantic_mode == 'majority':
+            semantic_frames = majority_downsample(semantic_frames, factors)
+        else:
+            semantic_frames = nearest_downsample(semantic_frames, factors)
+        if self.depth_mode == 'min':
+            depth_frames = min_downsample(depth_frames, factors)
+        else:
+            depth_frames = nearest_downsample(depth_frames, factors)
+        return color_frames, semantic_frames, depth_frames
@@ -0,0 +1,192 @@
+"""Vectorized helpers to analyze instance segmentation frames.
+"""
+
+import numpy as np
+
+# largest id for which a dense bincount is used instead of sorting the frame
+MAX_DENSE_ID = 1 << 20
+
+
+def unique_with_inverse(semantic_frame):
+    """Return the sorted unique ids of a frame and the index of each pixel into them.
+
+    For the small, non-negative ids used by Replica a dense bincount is used, which avoids
+    sorting all pixels as np.unique would.
+
+    Args:
+        semantic_frame: Integer array of arbitrary shape.
+    Returns:
+        Tuple (ids, inverse, counts), where inverse has the shape of semantic_frame.
+    """
+    values = semantic_frame.ravel()
+    if values.size and values.min() >= 0 and values.max() < MAX_DENSE_ID:
+        dense_counts = np.bincount(values)
+        ids = np.flatnonzero(dense_counts)
+        lut = np.zeros(len(dense_counts), dtype=np.intp)
+        lut[ids] = np.arange(len(ids))
+        inverse = lut[values]
+        counts = dense_counts[ids]
+        ids = ids.astype(semantic_frame.dtype)
+    else:
+        ids, inverse, counts = np.unique(values, return_inverse=True, return_counts=True)
+    return ids, inverse.reshape(semantic_frame.shape), counts
+
+
+def _first_and_last_occurrence(presence):
+    """Return first and last index along axis 0 at which each column of presence is True.
+    """
+    first = presence.argmax(axis=0)
+    last = presence.shape[0] - 1 - presence[::-1].argmax(axis=0)
+    return first, last
+
+
+def compute_segment_statistics(semantic_frame):
+    """Compute area and bounding box of all segments in a frame in a single pass.
+
+    This replaces a loop over the unique ids which would create a full frame mask per segment.
+
+    Args:
+        semantic_frame: 2D integer array of segment ids.
+    Returns:
+        Tuple (ids, areas, bboxes). ids are the sorted unique ids of the frame, areas the pixel
+        count of each segment and bboxes an (N, 4) array of inclusive minx, miny, maxx, maxy.
+    """
+    height, width = semantic_frame.shape
+    ids, inverse, areas = unique_with_inverse(semantic_frame)
+    num_ids = len(ids)
+
+    # presence of each segment in each row / column, computed from one bincount each
+    row_presence = np.bincount((inverse + np.arange(height)[:, None] * num_ids).ravel(),
+                               minlength=height * num_ids).reshape(height, num_ids) > 0
+    column_presence = np.bincount((inverse + np.arange(width)[None, :] * num_ids).ravel(),
+                                  minlength=width * num_ids).reshape(width, num_ids) > 0
+    miny, maxy = _first_and_last_occurrence(row_presence)
+    minx, maxx = _first_and_last_occurrence(column_presence)
+
+    bboxes = np.stack([minx, miny, maxx, maxy], axis=1)
+    return ids, areas, bboxes
+
+
+# maximum number of characters of a single count in the compressed RLE format of the COCO api
+_MAX_RLE_COUNT_CHARS = 13
+
+
+def _rle_counts_to_strings(counts, group_starts):
+    """Compress groups of RLE counts into strings as done by rleToString of the COCO api.
+
+    All counts are encoded at once, each count by a variable number of 5 bit characters.
+
+    Args:
+        counts: Flat int64 array of the counts of all groups.
+        group_starts: Index of the first count of each group in counts.
+    Returns:
+        List with one string per group.
+    """
+    # all counts except the first three of a group are stored as difference to the count two before
+    local_index = np.arange(len(counts)) - np.repeat(group_starts, np.diff(np.append(group_starts, len(counts))))
+    values = counts.copy()
+    delta = local_index > 2
+    values[delta] -= counts[np.flatnonzero(delta) - 2]
+
+    chars = np.empty((len(values), _MAX_RLE_COUNT_CHARS), dtype=np.uint8)
+    num_chars = np.zeros(len(values), dtype=np.int64)
+    active = np.ones(len(values), dtype=bool)
+    for i in range(_MAX_RLE_COUNT_CHARS):
+        c = values & 0x1f
+        values = values >> 5
+        more = np.where(c & 0x10, values != -1, values != 0)
+        chars[:, i] = c + 48 + 0x20 * more
+        num_chars += active
+        active &= more
+        if not active.any():
+            break
+    text = chars[np.arange(_MAX_RLE_COUNT_CHARS) < num_chars[:, None]].tobytes().decode('ascii')
+
+    ends = np.cumsum(np.add.reduceat(num_chars, group_starts))
+    return [text[start:end] for start, end in zip(np.concatenate([[0], ends[:-1]]), ends)]
+
+
+def compute_rle_counts(semantic_frame, ids):
+    """Compute the compressed COCO RLE of the mask of each of the given ids in a single pass.
+
+    Instead of creating and encoding one mask per id, the runs of the column-major frame are
+    computed once and distributed to the ids.
+
+    Args:
+        semantic_frame: 2D integer array of segment ids.
+        ids: Sorted ids occurring in the frame.
+    Returns:
+        List of the 'counts' strings of the RLE of each id, the RLE 'size' is the shape of the frame.
+    """
+    ids = np.asarray(ids, dtype=semantic_frame.dtype)
+    if len(ids) == 0:
+        return []
+
+    # runs of equal ids in column-major order, as used by COCO
+    values = semantic_frame.T.ravel()
+    starts = np.flatnonzero(np.concatenate([[True], values[1:] != values[:-1]]))
+    lengths = np.diff(np.append(starts, len(values)))
+    run_ids = values[starts]
+
+    # runs of the requested ids, grouped by id and in pixel order within each group
+    selected = np.flatnonzero(np.isin(run_ids, ids))
+    selected = selected[np.argsort(run_ids[selected], kind='stable')]
+    groups = np.searchsorted(ids, run_ids[selected])
+    starts, lengths = starts[selected], lengths[selected]
+    ends = starts + lengths
+    first = np.concatenate([[True], groups[1:] != groups[:-1]])
+    gaps = starts - np.where(first, 0, np.roll(ends, 1))
+
+    # counts of a group alternate zeros and ones, starting with zeros and ending with the trailing zeros
+    runs_per_group = np.bincount(groups, minlength=len(ids))
+    last_ends = ends[np.cumsum(runs_per_group) - 1]
+    trailing = len(values) - last_ends
+    group_sizes = 2 * runs_per_group + (trailing > 0)
+    group_starts = np.concatenate([[0], np.cumsum(group_sizes)[:-1]])
+
+    counts = np.empty(group_sizes.sum(), dtype=np.int64)
+    run_index = np.arange(len(selected)) - np.repeat(np.cumsum(runs_per_group) - runs_per_group, runs_per_group)
+    counts[group_starts[groups] + 2 * run_index] = gaps
+    counts[group_starts[groups] + 2 * run_index + 1] = lengths
+    has_trailing = trailing > 0
+    counts[group_starts[has_trailing] + 2 * runs_per_group[has_trailing]] = trailing[has_trailing]
+
+    return _rle_counts_to_strings(counts, group_starts)
+
+
+class SceneLabels:
+    """Lookup tables compiled once per scene from the id_to_label list of info_semantic.json.
+
+    Replica *should* have no 0 label by default. Ids with label 0 are kept in the semantic frames,
+    but considered as unlabeled, i.e., no annotation is created for them.
+
+    Args:
+        id_to_label: Label of each raw instance id.
+        thing_labels: Labels of thing categories, see convert_categories.
+    """
+    def __init__(self, id_to_label, thing_labels=()):
+        # label of each raw instance id
+        self.labels = np.asarray(id_to_label, dtype=np.int64)
+
+        # whether each raw instance id belongs to a thing category
+        self.is_thing = np.isin(self.labels, list(thing_labels))
+
+        # output id of each raw instance id, negative labels are mapped to 0 to conform to COCO format
+        self.id_remap = np.arange(len(self.labels), dtype=np.uint32)
+        self.id_remap[self.labels < 0] = 0
+
+        # raw ids with the unexpected label 0
+        self.is_zero_label = self.labels == 0
+        self._has_zero_labels = bool(np.any(self.is_zero_label))
+
+    def fix_semantic_observation(self, semantic_observation):
+        """Remap all ids of a frame in one lookup.
+        """
+        return self.id_remap[semantic_observation]
+
+    def zero_label_frames(self, semantic_observations):
+        """Return whether each frame of a batch of raw frames contains an id with the unexpected label 0.
+        """
+        if not self._has_zero_labels:
+            return np.zeros(len(semantic_observations), dtype=bool)
+        return self.is_zero_label[semantic_observations].reshape(len(semantic_observations), -1).any(axis=1)
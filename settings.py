@@ -20,6 +20,10 @@ default_sim_settings = {
     "depth_sensor": False,  # depth sensor (default: OFF)
     "seed": 1,
     "silent": False,  # do not print log info (default: OFF)
+    "num_agents": 1,  # number of identical agents, e.g., to render multiple poses per step
+    "num_probe_agents": 0,  # number of agents with low resolution depth and semantic sensors
+    "probe_width": 40,
+    "probe_height": 30,
     # settings exclusive to example.py
     "save_png": False,  # save the pngs to disk (default: OFF)
     "print_semantic_scene": False,
@@ -35,6 +39,26 @@ default_sim_settings = {
     "test_object_index": 0,
 }
 
+# create sensor specifications from a dictionary of sensor parameters
+def make_sensor_specs(sensors, silent):
+    sensor_specs = []
+    for sensor_uuid, sensor_params in sensors.items():
+        sensor_spec = hsim.SensorSpec()
+        sensor_spec.uuid = sensor_uuid
+        sensor_spec.sensor_type = sensor_params["sensor_type"]
+        sensor_spec.resolution = sensor_params["resolution"]
+        sensor_spec.position = sensor_params["position"]
+        sensor_spec.gpu2gpu_transfer = False
+        if not silent:
+            print("==== Initialized Sensor Spec: =====")
+            print("Sensor uuid: ", sensor_spec.uuid)
+            print("Sensor type: ", sensor_spec.sensor_type)
+            print("Sensor position: ", sensor_spec.position)
+            print("===================================")
+
+        sensor_specs.append(sensor_spec)
+    return sensor_specs
+
 # build SimulatorConfiguration
 def make_cfg(settings):
     sim_cfg = hsim.SimulatorConfiguration()
@@ -44,7 +68,8 @@ def make_cfg(settings):
         sim_cfg.enable_physics = False
     if "physics_config_file" in settings.keys():
         sim_cfg.physics_config_file = settings["physics_config_file"]
-    print("sim_cfg.physics_config_file = " + sim_cfg.physics_config_file)
+    if not settings["silent"]:
+        print("sim_cfg.physics_config_file = " + sim_cfg.physics_config_file)
     sim_cfg.gpu_device_id = 0
     sim_cfg.scene.id = settings["scene"]
 
@@ -68,23 +93,10 @@ def make_cfg(settings):
     }
 
     # create sensor specifications
-    sensor_specs = []
-    for sensor_uuid, sensor_params in sensors.items():
-        if settings[sensor_uuid]:
-            sensor_spec = hsim.SensorSpec()
-            sensor_spec.uuid = sensor_uuid
-            sensor_spec.sensor_type = sensor_params["sensor_type"]
-            sensor_spec.resolution = sensor_params["resolution"]
-            sensor_spec.position = sensor_params["position"]
-            sensor_spec.gpu2gpu_transfer = False
-            if not settings["silent"]:
-                print("==== Initialized Sensor Spec: =====")
-                print("Sensor uuid: ", sensor_spec.uuid)
-                print("Sensor type: ", sensor_spec.sensor_type)
-                print("Sensor position: ", sensor_spec.position)
-                print("===================================")
-
-            sensor_specs.append(sensor_spec)
+    sensor_specs = make_sensor_specs(
+        {sensor_uuid: sensor_params for sensor_uuid, sensor_params in sensors.items() if settings[sensor_uuid]},
+        settings["silent"],
+    )
 
     # create agent specifications
     agent_cfg = habitat_sim.agent.AgentConfiguration()
@@ -109,4 +121,17 @@ def make_cfg(settings):
             )
         }
 
-    return habitat_sim.Configuration(sim_cfg, [agent_cfg])
+    agent_cfgs = [agent_cfg] * settings.get("num_agents", 1)
+
+    # probe agents with low resolution depth and semantic sensors, appended after the other agents
+    if settings.get("num_probe_agents", 0) > 0:
+        probe_sensors = {
+            sensor_uuid: dict(sensors[sensor_uuid], resolution=[settings["probe_height"], settings["probe_width"]])
+            for sensor_uuid in ["depth_sensor", "semantic_sensor"]
+        }
+        probe_cfg = habitat_sim.agent.AgentConfiguration()
+        probe_cfg.sensor_specifications = make_sensor_specs(probe_sensors, settings["silent"])
+        probe_cfg.action_space = agent_cfg.action_space
+        agent_cfgs += [probe_cfg] * settings["num_probe_agents"]
+
+    return habitat_sim.Configuration(sim_cfg, agent_cfgs)
@@ -0,0 +1,223 @@
+"""Encoding and writing of observations, optionally overlapped with rendering.
+"""
+
+import collections
+import concurrent.futures
+import multiprocessing
+import os
+import struct
+import time
+import zlib
+
+import numpy as np
+from PIL import Image
+
+from array_dataset import DEPTH_FORMAT as ARRAY_DEPTH_FORMAT, DEPTH_SCALE, metric_to_depth_array
+
+# zlib level of the pngs, 6 is the default of PIL
+DEFAULT_PNG_COMPRESSION = 6
+
+# zlib level of the png16 depth images, such that they encode faster than the png8 ones at the default level
+DEFAULT_PNG16_COMPRESSION = 1
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+# formats of the depth files:
+#     png8: uint8 png of depth / 10 * 255, i.e., 4cm steps up to 10m
+#     png16: uint16 png of the depth in millimeters, up to 65.535m
+#     float16 / float32: .npy file of the metric depth
+DEPTH_FORMATS = ['png8', 'png16', 'float16', 'float32']
+
+
+def save_image(img, path, compress_level=DEFAULT_PNG_COMPRESSION):
+    """Save a PIL image as png, such that the file only exists once it has been written completely.
+    """
+    img.save(path + '.tmp', format='PNG', compress_level=compress_level)
+    os.replace(path + '.tmp', path)
+
+
+def write_color_image(color_observation, path, compress_level=DEFAULT_PNG_COMPRESSION):
+    color_img = Image.fromarray(color_observation, mode="RGBA")
+    save_image(color_img, path, compress_level)
+
+
+def write_semantic_image(semantic_observation, path, compress_level=DEFAULT_PNG_COMPRESSION):
+    semantic_img = Image.new("I", (semantic_observation.shape[1], semantic_observation.shape[0]))
+    semantic_img.putdata((semantic_observation.flatten()))
+    save_image(semantic_img, path, compress_level)
+
+
+def read_semantic_image(path):
+    """Read a semantic image written by write_semantic_image.
+    """
+    with Image.open(path) as semantic_img:
+        return np.array(semantic_img)
+
+
+def depth_extension(depth_format):
+    return '.npy' if depth_format.startswith('float') else '.png'
+
+
+def depth_scale(depth_format):
+    """Return the number of stored depth units per meter of a depth format.
+    """
+    return {'png8': 255 / 10, 'png16': DEPTH_SCALE, ARRAY_DEPTH_FORMAT: DEPTH_SCALE}.get(depth_format, 1)
+
+
+def encode_depth(depth_observations, depth_format):
+    """Convert a batch of metric depth frames to the stored values of a depth format.
+    """
+    if depth_format == 'png8':
+        return (depth_observations / 10 * 255).astype(np.uint8)
+    if depth_format == 'png16':
+        return metric_to_depth_array(depth_observations)
+    return depth_observations.astype(depth_format)
+
+
+def _png_chunk(chunk_type, data):
+    return struct.pack('>I', len(data)) + chunk_type + data + struct.pack('>I', zlib.crc32(chunk_type + data))
+
+
+def encode_png16(image, compress_level=DEFAULT_PNG16_COMPRESSION):
+    """Encode a uint16 image as 16 bit grayscale png.
+
+    All rows use the Up filter (difference to the row above), which is computed for the whole image at
+    once. This is about twice as fast as PIL's encoder and compresses smooth depth better.
+    """
+    height, width = image.shape
+    data = image.astype('>u2').view(np.uint8).reshape(height, 2 * width)
+    rows = np.empty((height, 2 * width + 1), dtype=np.uint8)
+    rows[:, 0] = 2 # filter type Up
+    rows[0, 1:] = data[0]
+    np.subtract(data[1:], data[:-1], out=rows[1:, 1:])
+    header = struct.pack('>IIBBBBB', width, height, 16, 0, 0, 0, 0) # 16 bit grayscale, no interlacing
+    return (PNG_SIGNATURE + _png_chunk(b'IHDR', header) + _png_chunk(b'IDAT', zlib.compress(rows.data, compress_level))
+            + _png_chunk(b'IEND', b''))
+
+
+def write_depth_image(depth_image, path, compress_level=DEFAULT_PNG_COMPRESSION):
+    """Write a uint8 (png8) or uint16 (png16) depth image.
+    """
+    if depth_image.dtype == np.uint8:
+        save_image(Image.fromarray(depth_image, mode="L"), path, compress_level)
+        return
+    with open(path + '.tmp', 'wb') as f:
+        f.write(encode_png16(depth_image, compress_level))
+    os.replace(path + '.tmp', path)
+
+
+def write_depth_array(depth_array, path):
+    """Write a float16 / float32 depth frame as .npy, such that the file only exists once it has been written completely.
+    """
+    with open(path + '.tmp', 'wb') as f:
+        np.save(f, depth_array)
+    os.replace(path + '.tmp', path)
+
+
+def detect_depth_format(folder):
+    """Return the depth format of the depth files in a folder, None if there are none.
+    """
+    filenames = sorted(os.listdir(folder)) if os.path.exists(folder) else []
+    for filename in filenames:
+        path = os.path.join(folder, filename)
+        if filename.endswith('.npy'):
+            return str(np.load(path, mmap_mode='r').dtype)
+        if filename.endswith('.png'):
+            with Image.open(path) as depth_img:
+                return 'png8' if depth_img.mode == 'L' else 'png16'
+    return None
+
+
+def read_depth(path, depth_format):
+    """Read a depth file written in a depth format and return the metric depth.
+    """
+    if depth_extension(depth_format) == '.npy':
+        return np.load(path).astype(np.float32)
+    with Image.open(path) as depth_img:
+        return np.array(depth_img).astype(np.float32) / depth_scale(depth_format)
+
+
+def _timed_call(function, *args):
+    """Run a write job and return its duration in seconds.
+    """
+    start = time.perf_counter()
+    function(*args)
+    return time.perf_counter() - start
+
+
+class ObservationWriter:
+    """Runs write jobs either synchronously or on a bounded pool of workers.
+
+    With workers > 0 a job is queued and the call returns immediately, such that the next frame
+    can be rendered while the previous one is encoded. If max_pending jobs are queued, submit
+    blocks until the oldest job is done (backpressure). Errors of jobs are raised by the next
+    submit or flush call.
+
+    The durations of finished jobs submitted with a stage name, and the time submit was blocked
+    (stage 'writer wait'), are collected and can be retrieved with pop_durations.
+
+    Args:
+        workers: Number of worker threads / processes. 0 writes synchronously.
+        max_pending: Maximum number of queued jobs, defaults to 4 jobs per worker.
+        use_processes: Use a process pool instead of a thread pool.
+    """
+    def __init__(self, workers=0, max_pending=None, use_processes=False):
+        self._max_pending = max_pending if max_pending is not None else 4 * workers
+        self._pending = collections.deque()
+        self._durations = []
+        if workers == 0:
+            self._executor = None
+        elif use_processes:
+            self._executor = concurrent.futures.ProcessPoolExecutor(
+                workers, mp_context=multiprocessing.get_context('spawn'))
+        else:
+            self._executor = concurrent.futures.ThreadPoolExecutor(workers)
+
+    @property
+    def is_async(self):
+        return self._executor is not None
+
+    def submit(self, function, *args, stage=None):
+        if self._executor is None:
+            self._record(stage, _timed_call(function, *args))
+            return
+
+        # raise errors as early as possible and block while too many jobs are queued
+        start = time.perf_counter()
+        while self._pending and (self._pending[0][1].done() or len(self._pending) >= self._max_pending):
+            self._pop_oldest()
+        self._record('writer wait', time.perf_counter() - start)
+        self._pending.append((stage, self._executor.submit(_timed_call, function, *args)))
+
+    def _pop_oldest(self):
+        stage, future = self._pending.popleft()
+        self._record(stage, future.result())
+
+    def _record(self, stage, seconds):
+        if stage is not None:
+            self._durations.append((stage, seconds))
+
+    def pop_durations(self):
+        """Return and reset the list of (stage, seconds) of the jobs finished so far.
+        """
+        durations, self._durations = self._durations, []
+        return durations
+
+    def flush(self):
+        """Wait until all queued jobs are written, raises the first error of a failed job.
+        """
+        while self._pending:
+            self._pop_oldest()
+
+    def close(self):
+        """Flush and shut down the workers.
+        """
+        try:
+            self.flush()
+        finally:
+            if self._executor is not None:
+                for _, future in self._pending:
+                    future.cancel()
+                self._pending.clear()
+                self._executor.shutdown()
+                self._executor = None